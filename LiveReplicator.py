@@ -1,12 +1,22 @@
 import datetime
 import optparse
+import signal
 import sys
 from urlparse import urlparse
 from twisted.internet import reactor
+from twisted.internet import stdio
+from twisted.internet import task
+from twisted.web.resource import Resource
+from twisted.web.server import Site
 from twisted.python import log
-from dash.DashPuller import DashPuller
-from dash.DashPusher import DashPusher
+from dash.ChannelManager import Channel, ChannelManager
+from dash.Supervisor import Supervisor, WorkerControl, STAT_FD, handle_worker_signals, worker_command
+from dash.HttpHelper import configurePool
+from dash.mpd.parser import MPDParser, BACKENDS as MPD_PARSER_BACKENDS
+from dash.SegmentStore import EVICTION_POLICIES
+from common.Metrics import MetricsResource
 from common.Statistic import Statistics
+from common.Trace import Tracer, TraceResource
 
 import logging
 
@@ -21,11 +31,39 @@ root.addHandler(ch)
 def parse_args():
     parser = optparse.OptionParser(usage=__doc__)
     parser.add_option("-s", "--src", type="string", dest="source", help="Set source HTTP path (master manifest)")
+    parser.add_option("-f", "--channels", type="string", dest="channels", help="Replicate the channels listed in this JSON file instead of a single source", default = None)
+    parser.add_option("-w", "--workers", type="int", dest="workers", help="Run the channels on x worker processes", default = 1)
+    parser.add_option("--worker", action="store_true", dest="worker", help=optparse.SUPPRESS_HELP, default = False)
+    parser.add_option("-u", "--reload-interval", type="int", dest="reload_interval", help="Check the channel file for changes every x seconds", default = 5)
     parser.add_option("-m", "--mpd-repeat", type="int", dest="mpd_repeat", help="Repeat manifest for every x rounds", default = 1)
     parser.add_option("-i", "--init-repeat", type="int", dest="init_repeat", help="Repeat init segment for every x rounds", default = 5)
     parser.add_option("-D", "--delete-after", type="int", dest="delete_after", help="Delete segments after x seconds", default = 60)
+    parser.add_option("-P", "--max-persistent-per-host", type="int", dest="max_persistent_per_host", help="Keep up to x idle connections per host", default = 10)
+    parser.add_option("-T", "--idle-timeout", type="int", dest="idle_timeout", help="Close idle connections after x seconds", default = 60)
+    parser.add_option("-r", "--relay", action="store_true", dest="relay", help="Upload media segments while they are downloaded", default = False)
+    parser.add_option("-W", "--window", type="int", dest="window", help="Upload up to x packages at the same time per destination", default = 1)
+    parser.add_option("-L", "--max-lag", type="int", dest="max_lag", help="Skip to the newest package when a destination is x packages behind", default = 15)
+    parser.add_option("-c", "--max-inflight-per-destination", type="int", dest="max_inflight_per_destination", help="Upload up to x files at the same time per destination (0: unlimited)", default = 10)
+    parser.add_option("-C", "--max-inflight", type="int", dest="max_inflight", help="Upload up to x files at the same time over all the channels of a process (0: unlimited)", default = 100)
+    parser.add_option("-R", "--rate-limit", type="int", dest="rate_limit", help="Upload up to x bytes per second per destination (0: unlimited)", default = 0)
+    parser.add_option("-t", "--retries", type="int", dest="retries", help="Retry failed downloads and uploads up to x times", default = 3)
+    parser.add_option("-H", "--hedge", action="store_true", dest="hedge", help="Send a second download request when the first one is slower than 95% of the recent ones", default = False)
+    parser.add_option("-d", "--max-parallel-downloads", type="int", dest="max_parallel_downloads", help="Download up to x segments at the same time", default = 16)
+    parser.add_option("-b", "--buffer-size", type="int", dest="buffer_size", help="Buffer up to x MB of segments per channel", default = 512)
+    parser.add_option("-e", "--eviction-policy", type="choice", choices=EVICTION_POLICIES, dest="eviction_policy", help="Which segments to evict when the buffer is full: drop-oldest or drop-lowest-bitrate", default = EVICTION_POLICIES[0])
+    parser.add_option("-k", "--cache-dir", type="string", dest="cache_dir", help="Keep media segments on the disk under this directory instead of in memory", default = None)
+    parser.add_option("-K", "--cache-retention", type="int", dest="cache_retention", help="Keep cached segments for x seconds", default = 3600)
+    parser.add_option("-M", "--metrics-port", type="int", dest="metrics_port", help="Serve the metrics for Prometheus on this port (0: disabled)", default = 0)
+    parser.add_option("-I", "--metrics-interval", type="int", dest="metrics_interval", help="Render the metrics every x seconds", default = 10)
+    parser.add_option("-z", "--trace-size", type="int", dest="trace_size", help="Keep the traces of the last x segments, served on the metrics port at /traces (0: disabled)", default = 0)
+    parser.add_option("-Z", "--trace-file", type="string", dest="trace_file", help="Append the segment traces to this file as JSON lines", default = None)
+    parser.add_option("-x", "--mpd-parser", type="choice", choices=MPD_PARSER_BACKENDS, dest="mpd_parser", help="MPD parser backend: {}".format(', '.join(MPD_PARSER_BACKENDS)), default = MPDParser.backend)
     (options, args) = parser.parse_args()
 
+    if options.channels:
+        options.destination = args
+        return options
+
     if not options.source:
         parser.error('Source path must be set')
     if not args:
@@ -51,21 +89,58 @@ def proxy_main():
     logger.info("Started: %s", datetime.datetime.now())
 
     stat = Statistics()
+    configurePool(options.max_persistent_per_host, options.idle_timeout, stat)
+    MPDParser.backend = options.mpd_parser
+    tracer = None
+    supervised = options.channels and options.workers > 1 and not options.worker
+    if options.trace_size or options.trace_file:
+        if options.worker:
+            # the traces are only forwarded to the supervisor, which keeps them and writes the file
+            tracer = Tracer(0)
+        else:
+            tracer = Tracer(options.trace_size, options.trace_file)
 
     """ Pulling data and buffer them internally """
-    if options.source.endswith(".mpd"):
-        puller = DashPuller(options.source)
-
-        pusher = DashPusher(options.destination, puller.consume, stat,
-                            mpd_repeat=options.mpd_repeat, init_segment_repeat=options.init_repeat, delete_after=options.delete_after)
-
-        reactor.callWhenRunning(puller.start)
-        reactor.callWhenRunning(pusher.start)
-
-        reactor.run()
+    refresh_stat = None
+    if options.worker:
+        # channels are given by the supervisor
+        manager = ChannelManager(None, vars(options), stat, tracer=tracer)
+        control = WorkerControl(manager, tracer)
+        stdio.StandardIO(control, stdin=0, stdout=STAT_FD)
+        # after the reactor has installed its own handlers
+        reactor.callWhenRunning(handle_worker_signals)
+        task.LoopingCall(control.report, stat).start(options.reload_interval, now=False)
+    elif supervised:
+        manager = Supervisor(options.channels, vars(options), stat, worker_command(), options.workers,
+                             options.reload_interval, tracer=tracer)
+        signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(manager.reload))
+        reactor.callWhenRunning(manager.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', manager.stop)
+        refresh_stat = manager.aggregate
+    elif options.channels:
+        manager = ChannelManager(options.channels, vars(options), stat, options.reload_interval, tracer)
+        # reload the channel file on SIGHUP without waiting for the next check
+        signal.signal(signal.SIGHUP, lambda signum, frame: reactor.callFromThread(manager.reload))
+        reactor.callWhenRunning(manager.start)
+    elif options.source.endswith(".mpd"):
+        channel = Channel('default', vars(options), stat, tracer)
+        reactor.callWhenRunning(channel.start)
     else:
         # later other protocol could be added.
         logger.error("Not supported input: %s", options.source)
+        return
+
+    # workers are scraped through the supervisor
+    if options.metrics_port and not options.worker:
+        root = Resource()
+        metrics = MetricsResource(stat, refresh_stat, options.metrics_interval)
+        root.putChild('metrics', metrics)
+        reactor.callWhenRunning(metrics.start)
+        if tracer is not None:
+            root.putChild('traces', TraceResource(tracer))
+        reactor.listenTCP(options.metrics_port, Site(root))
+
+    reactor.run()
 
 if __name__ == '__main__':
     proxy_main()
\ No newline at end of file
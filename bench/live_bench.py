@@ -0,0 +1,141 @@
+"""
+Live load benchmark. Starts the fake origin and ingest of bench.servers in a child process,
+replicates `channels` channels from it with DashPuller/DashPusher in this process for
+`duration` seconds and reports the throughput, the latency percentiles and the CPU and
+memory used by the replication.
+
+Usage: python -m bench.live_bench [options]
+"""
+import json
+import optparse
+import resource
+import subprocess
+import sys
+import time
+
+from twisted.internet import reactor
+
+from dash.DashPuller import DashPuller
+from dash.DashPusher import DashPusher
+from common.Statistic import Histogram, Statistics
+
+import logging
+
+HISTOGRAMS = ['download_seconds', 'upload_seconds', 'upload_round_seconds', 'availability_delay_seconds']
+
+
+def parse_args():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--duration", type="int", dest="duration", help="Run for x seconds", default=60)
+    parser.add_option("--channels", type="int", dest="channels", default=1)
+    parser.add_option("--template", type="choice", choices=["number", "timeline", "static"], dest="template", default="number")
+    parser.add_option("--destinations", type="int", dest="destinations", help="Destinations per channel", default=2)
+    parser.add_option("--relay", action="store_true", dest="relay", default=False)
+    parser.add_option("--origin-port", type="int", dest="origin_port", default=8900)
+    parser.add_option("--ingest-port", type="int", dest="ingest_port", default=8901)
+    # passed to bench.servers
+    parser.add_option("--segment-size", type="string", dest="segment_size", default="500000")
+    parser.add_option("--segment-duration", type="string", dest="segment_duration", default="2")
+    parser.add_option("--adaptation-sets", type="string", dest="adaptation_sets", default="2")
+    parser.add_option("--representations", type="string", dest="representations", default="4")
+    parser.add_option("--latency", type="string", dest="latency", default="0")
+    parser.add_option("--jitter", type="string", dest="jitter", default="0")
+    parser.add_option("--failure-rate", type="string", dest="failure_rate", default="0")
+    return parser.parse_args()[0]
+
+
+def start_servers(options):
+    command = [sys.executable, '-m', 'bench.servers']
+    for name in ['origin_port', 'ingest_port', 'segment_size', 'segment_duration', 'adaptation_sets',
+                 'representations', 'latency', 'jitter', 'failure_rate']:
+        command += ['--' + name.replace('_', '-'), str(getattr(options, name))]
+    servers = subprocess.Popen(command, stdout=subprocess.PIPE)
+    # let it listen
+    time.sleep(1)
+    return servers
+
+
+def start_channel(options, index, stat):
+    source = 'http://127.0.0.1:{}/ch{}/{}.mpd'.format(options.origin_port, index, options.template)
+    destinations = ['http://127.0.0.1:{}/ch{}/d{}/'.format(options.ingest_port, index, destination)
+                    for destination in range(options.destinations)]
+    channel_stat = stat.scope(channel='ch{}'.format(index))
+    puller = DashPuller(source, stat=channel_stat)
+    pusher = DashPusher(destinations, puller.consume, channel_stat, relay=options.relay, store=puller.media_segments)
+    if options.relay:
+        puller.relay = pusher.relay_segment
+    puller.add_listener(pusher.notify)
+    puller.start()
+    pusher.start()
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1048576.0
+    except IOError:
+        return None
+
+
+"""
+Sum the labelled values of a counter, e.g. uploaded_bytes of every channel and destination
+"""
+def total(stat, name):
+    return sum(value for key, value in stat.data.items() if key.split('{')[0] == name)
+
+
+"""
+Merge the labelled histograms of a name into one
+"""
+def merged_histogram(stat, name):
+    merged = None
+    for key, value in stat.data.items():
+        if key.split('{')[0] == name:
+            if merged is None:
+                merged = Histogram(value.buckets)
+            merged.merge(value)
+    return merged
+
+
+def report(options, stat, elapsed, cpu, ingest):
+    print "{} channels, {} template, {} destinations each, {}s".format(
+        options.channels, options.template, options.destinations, options.duration)
+    print "Throughput: {:.2f} MB/s pulled, {:.2f} MB/s pushed, {} segments pushed, {} upload retries, {} upload failures".format(
+        total(stat, 'downloaded_bytes') / 1048576.0 / elapsed, total(stat, 'uploaded_bytes') / 1048576.0 / elapsed,
+        total(stat, 'uploaded_file_count'), total(stat, 'upload_retry_count'), total(stat, 'uploading_failure_count'))
+    for name in HISTOGRAMS:
+        histogram = merged_histogram(stat, name)
+        if histogram is None or histogram.count == 0:
+            continue
+        print "{:>28}: p50 {:8.1f} ms  p95 {:8.1f} ms  p99 {:8.1f} ms  max {:8.1f} ms  ({} samples)".format(
+            name, histogram.percentile(0.5) * 1000, histogram.percentile(0.95) * 1000,
+            histogram.percentile(0.99) * 1000, histogram.max * 1000, histogram.count)
+    print "CPU: {:.1f}% of a core, RSS: {:.1f} MB (peak {:.1f} MB)".format(
+        cpu * 100 / elapsed, rss_mb() or 0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+    print "Ingest: {}".format(', '.join('{} {}'.format(key, ingest[key]) for key in sorted(ingest)))
+
+
+def main():
+    options = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    servers = start_servers(options)
+    stat = Statistics()
+    try:
+        for index in range(options.channels):
+            reactor.callWhenRunning(start_channel, options, index, stat)
+        reactor.callLater(options.duration, reactor.stop)
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        started_at = time.time()
+        reactor.run()
+        elapsed = time.time() - started_at
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = (end_usage.ru_utime - usage.ru_utime) + (end_usage.ru_stime - usage.ru_stime)
+    finally:
+        servers.terminate()
+    ingest = servers.communicate()[0].strip().split('\n')[-1]
+    report(options, stat, elapsed, cpu, json.loads(ingest) if ingest else {})
+
+
+if __name__ == '__main__':
+    main()
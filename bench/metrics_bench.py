@@ -0,0 +1,49 @@
+"""
+Benchmark of the Prometheus exposition of the statistics of many channels: every destination
+of every channel has the three upload histograms of DashPusher, observed as many times as the
+histograms have buckets so every bucket line is filled in.
+
+Usage: python -m bench.metrics_bench [channels] [destinations]
+"""
+import random
+import sys
+import time
+
+from common.Metrics import prometheus_text
+from common.Statistic import Statistics, COARSE_BUCKETS, DEFAULT_BUCKETS
+
+HISTOGRAMS = ['upload_seconds', 'upload_round_seconds', 'availability_delay_seconds']
+ROUNDS = 3
+
+
+def fill(channels, destinations, buckets):
+    stat = Statistics()
+    for channel in xrange(channels):
+        channel_stat = stat.scope(channel='ch{}'.format(channel))
+        for destination in xrange(destinations):
+            url = 'http://ingest{}.example.com/ch{}/'.format(destination, channel)
+            channel_stat.append('uploaded_bytes', 1000000, destination=url)
+            for name in HISTOGRAMS:
+                for _ in xrange(len(buckets)):
+                    channel_stat.observe(name, random.expovariate(2.0), buckets=buckets, destination=url)
+    return stat
+
+
+def measure(stat):
+    started = time.time()
+    for _ in range(ROUNDS):
+        text = prometheus_text(stat)
+    return (time.time() - started) / ROUNDS, len(text)
+
+
+def main():
+    channels = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    destinations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print "{} channels x {} destinations x {} histograms".format(channels, destinations, len(HISTOGRAMS))
+    for label, buckets in [('default', DEFAULT_BUCKETS), ('coarse', COARSE_BUCKETS)]:
+        elapsed, size = measure(fill(channels, destinations, buckets))
+        print "{:>8} buckets ({:2d}): {:7.3f} s per render, {:6.1f} MB".format(label, len(buckets), elapsed,
+                                                                            size / 1048576.0)
+
+if __name__ == '__main__':
+    main()
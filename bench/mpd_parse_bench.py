@@ -0,0 +1,118 @@
+"""
+Benchmark of the MPD parser backends on a large multi-period SegmentTimeline MPD.
+Reports the parse time per backend, the memory taken by the parsed MPD with the __slots__ nodes
+and with the same nodes laid out with an instance __dict__, and the time MPDInterpreter takes
+per refresh with a full parse and with the replication projection.
+
+Usage: python -m bench.mpd_parse_bench [segments per timeline]
+"""
+import gc
+import sys
+import time
+
+from dash.DashPuller import MPDInterpreter, REPLICATION_PROJECTION
+from dash.mpd.nodes import XMLNode
+from dash.mpd.parser import MPDParser, lxml_etree
+from dash.mpd.utils import FULL_PARSE, ParseOptions
+from bench.synthetic import timeline_mpd
+
+ROUNDS = 10
+
+
+def measure(mpd_string, backend):
+    gc.collect()
+    started = time.time()
+    for _ in range(ROUNDS):
+        MPDParser.parse(mpd_string, backend)
+    return (time.time() - started) / ROUNDS
+
+
+def measure_interpreter(mpd_string, backend, options):
+    MPDParser.backend = backend
+    MPDInterpreter.parse_options = options
+    gc.collect()
+    started = time.time()
+    for _ in range(ROUNDS):
+        MPDInterpreter('http://127.0.0.1/live.mpd', mpd_string)
+    return (time.time() - started) / ROUNDS
+
+
+class DictNode(object):
+    pass
+
+
+def slot_values(obj):
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            if hasattr(obj, name):
+                yield name, getattr(obj, name)
+
+
+"""
+Size in bytes of a parsed MPD, walking every object reachable from it once, with the nodes as
+they are (__slots__) and as they would be with an instance __dict__ holding the same attributes.
+Walking the objects keeps the figures independent of what the heap of the process already holds.
+"""
+def measure_memory(mpd_string, backend):
+    mpd = MPDParser.parse(mpd_string, backend)
+    empty_dict_node = sys.getsizeof(DictNode())
+    seen = set()
+    pending = [mpd]
+    slots_size = dict_size = nodes = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+        size = sys.getsizeof(obj)
+        if isinstance(obj, XMLNode):
+            nodes += 1
+            values = dict(slot_values(obj))
+            slots_size += size
+            dict_size += empty_dict_node + sys.getsizeof(values)
+            pending.extend(values.itervalues())
+            continue
+        slots_size += size
+        dict_size += size
+        if isinstance(obj, dict):
+            pending.extend(obj.iterkeys())
+            pending.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        if hasattr(obj, '__dict__'):
+            pending.append(obj.__dict__)
+        pending.extend(value for _, value in slot_values(obj))
+    return slots_size, dict_size, nodes, len(seen)
+
+
+def main():
+    segments = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    mpd_string = timeline_mpd(segments, periods=3, adaptation_sets=3, representations=5)
+    print "MPD: {} KB, 3 periods, {} segments per timeline".format(len(mpd_string) / 1024, segments)
+
+    backends = ['minidom', 'etree']
+    if lxml_etree is not None:
+        backends.append('lxml')
+    baseline = None
+    for backend in backends:
+        elapsed = measure(mpd_string, backend)
+        baseline = baseline or elapsed
+        print "{:>8}: {:8.2f} ms per parse ({:.1f}x)".format(backend, elapsed * 1000, baseline / elapsed)
+
+    slots_size, dict_size, nodes, objects = measure_memory(mpd_string, backends[-1])
+    print "Parsed MPD: {} nodes, {} objects".format(nodes, objects)
+    print "{:>17}: {:8.0f} KB".format('__dict__ nodes', dict_size / 1024.0)
+    print "{:>17}: {:8.0f} KB ({:.1f}x)".format('__slots__ nodes', slots_size / 1024.0,
+                                               float(dict_size) / slots_size)
+
+    print "MPDInterpreter ({}):".format(backends[-1])
+    baseline = None
+    for name, options in [('full', FULL_PARSE),
+                          ('projection', ParseOptions(tags=REPLICATION_PROJECTION.tags)),
+                          ('projection, lazy', REPLICATION_PROJECTION)]:
+        elapsed = measure_interpreter(mpd_string, backends[-1], options)
+        baseline = baseline or elapsed
+        print "{:>17}: {:8.2f} ms per refresh ({:.1f}x)".format(name, elapsed * 1000, baseline / elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+Local fake origin and ingest servers for the live benchmark.
+
+The origin serves a synthetic live stream under any path prefix, e.g. /ch1/number.mpd
+($Number$ template) and /ch1/timeline.mpd (SegmentTimeline), whose live edge moves
+with the clock, and /ch1/static.mpd, a $Number$ template MPD which never changes: its
+period is open so the live edge is only known from the clock. Every segment is `segment_size` bytes.
+The ingest accepts POST, PUT and DELETE, answering after `latency` (+ up to `jitter`)
+seconds and failing `failure_rate` of the requests with 503.
+The counters of the ingest are printed as one JSON line when the servers stop.
+
+Usage: python -m bench.servers [options]
+"""
+import json
+import optparse
+import random
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.web import server
+from twisted.web.resource import Resource
+
+from bench.synthetic import number_mpd, timeline_mpd
+
+
+class Origin(Resource):
+    isLeaf = True
+
+    def __init__(self, segment_size, segment_duration=2, adaptation_sets=2, representations=4,
+                 time_shift_buffer_depth=30):
+        Resource.__init__(self)
+        self.payload = 'x' * segment_size
+        self.segment_duration = segment_duration
+        self.adaptation_sets = adaptation_sets
+        self.representations = representations
+        self.time_shift_buffer_depth = time_shift_buffer_depth
+        # the stream starts a buffer depth before the server so there is a full window right away
+        self.started_at = int(time.time()) - time_shift_buffer_depth
+        self.availability_start_time = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started_at))
+
+    def render_GET(self, request):
+        if request.path.endswith('number.mpd'):
+            return self.number_mpd()
+        if request.path.endswith('timeline.mpd'):
+            return self.timeline_mpd()
+        if request.path.endswith('static.mpd'):
+            return self.static_mpd()
+        return self.payload
+
+    def number_mpd(self):
+        return number_mpd(int(time.time()) - self.started_at, self.segment_duration,
+                          adaptation_sets=self.adaptation_sets, representations=self.representations,
+                          time_shift_buffer_depth=self.time_shift_buffer_depth,
+                          availability_start_time=self.availability_start_time)
+
+    def static_mpd(self):
+        return number_mpd(None, self.segment_duration,
+                          adaptation_sets=self.adaptation_sets, representations=self.representations,
+                          time_shift_buffer_depth=self.time_shift_buffer_depth,
+                          availability_start_time=self.availability_start_time)
+
+    def timeline_mpd(self):
+        last_segment = (int(time.time()) - self.started_at) // self.segment_duration
+        first_segment = max(0, last_segment - self.time_shift_buffer_depth // self.segment_duration)
+        return timeline_mpd(last_segment - first_segment, self.segment_duration, first_segment,
+                            adaptation_sets=self.adaptation_sets, representations=self.representations,
+                            time_shift_buffer_depth=self.time_shift_buffer_depth,
+                            availability_start_time=self.availability_start_time)
+
+
+class Ingest(Resource):
+    isLeaf = True
+
+    def __init__(self, latency=0, jitter=0, failure_rate=0):
+        Resource.__init__(self)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.counters = {}
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def render(self, request):
+        method = request.method
+        if method not in ('POST', 'PUT', 'DELETE'):
+            request.setResponseCode(405)
+            return ''
+        body = request.content.read()
+        self.count(method)
+        self.count(method + '_bytes', len(body))
+        delay = self.latency + random.random() * self.jitter
+        failed = random.random() < self.failure_rate
+        if failed:
+            self.count(method + '_failed')
+        if delay <= 0:
+            return self.respond(request, failed)
+        d = task.deferLater(reactor, delay, self.respond, request, failed)
+        d.addCallback(self.finish, request)
+        return server.NOT_DONE_YET
+
+    def respond(self, request, failed):
+        if failed:
+            request.setResponseCode(503)
+        return ''
+
+    def finish(self, body, request):
+        # the client may have given up in the meantime
+        if not request.finished and not request._disconnected:
+            request.write(body)
+            request.finish()
+
+
+def parse_args():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option("--origin-port", type="int", dest="origin_port", default=8900)
+    parser.add_option("--ingest-port", type="int", dest="ingest_port", default=8901)
+    parser.add_option("--segment-size", type="int", dest="segment_size", help="Bytes per segment", default=500000)
+    parser.add_option("--segment-duration", type="int", dest="segment_duration", default=2)
+    parser.add_option("--adaptation-sets", type="int", dest="adaptation_sets", default=2)
+    parser.add_option("--representations", type="int", dest="representations", help="Representations per adaptation set", default=4)
+    parser.add_option("--latency", type="float", dest="latency", help="Seconds before the ingest answers", default=0)
+    parser.add_option("--jitter", type="float", dest="jitter", help="Up to x more seconds before the ingest answers", default=0)
+    parser.add_option("--failure-rate", type="float", dest="failure_rate", help="Ratio of the ingest requests failing with 503", default=0)
+    return parser.parse_args()[0]
+
+
+def main():
+    options = parse_args()
+    origin = Origin(options.segment_size, options.segment_duration, options.adaptation_sets, options.representations)
+    ingest = Ingest(options.latency, options.jitter, options.failure_rate)
+    reactor.listenTCP(options.origin_port, server.Site(origin))
+    reactor.listenTCP(options.ingest_port, server.Site(ingest))
+
+    def report():
+        print json.dumps(ingest.counters)
+        sys.stdout.flush()
+    reactor.addSystemEventTrigger('before', 'shutdown', report)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Synthetic live MPDs for the benchmarks.
+"""
+
+"""
+Whole seconds as xs:duration, e.g. PT90S
+"""
+def xs_duration(seconds):
+    return 'PT{}S'.format(int(seconds))
+
+MPD_HEAD = '''<?xml version="1.0" encoding="utf-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="dynamic" profiles="urn:mpeg:dash:profile:isoff-live:2011"
+     availabilityStartTime="{availability_start_time}" publishTime="{publish_time}"
+     minimumUpdatePeriod="{segment_duration}" timeShiftBufferDepth="{time_shift_buffer_depth}"
+     minBufferTime="{segment_duration}">
+  <ProgramInformation lang="en"><Title>Synthetic live stream</Title></ProgramInformation>
+'''
+
+MPD_TAIL = '''</MPD>
+'''
+
+"""
+Number based MPD. The last period is `duration` seconds long so the live edge is at
+segment number duration / segment_duration. Without `duration` the period is open and the
+live edge moves with the clock, so the MPD does not change between refreshes.
+"""
+def number_mpd(duration, segment_duration=2, periods=1, adaptation_sets=2, representations=4,
+               time_shift_buffer_depth=30, availability_start_time='1970-01-01T00:00:00Z', publish_time=None):
+    parts = [MPD_HEAD.format(availability_start_time=availability_start_time,
+                             publish_time=publish_time or availability_start_time,
+                             segment_duration=xs_duration(segment_duration),
+                             time_shift_buffer_depth=xs_duration(time_shift_buffer_depth))]
+    for period in range(periods):
+        if duration is None:
+            parts.append('  <Period id="p{0}" start="PT0S">\n'.format(period))
+        else:
+            parts.append('  <Period id="p{0}" start="PT0S" duration="{1}">\n'.format(period, xs_duration(duration)))
+        for adaptation_set in range(adaptation_sets):
+            content_type = 'video' if adaptation_set == 0 else 'audio'
+            parts.append('    <AdaptationSet id="{0}" contentType="{1}" segmentAlignment="true">\n'
+                         .format(adaptation_set, content_type))
+            parts.append('      <SegmentTemplate timescale="1000" duration="{0}" startNumber="1" '
+                         'media="p{1}_$RepresentationID$_$Number$.m4s" initialization="p{1}_$RepresentationID$_init.mp4"/>\n'
+                         .format(segment_duration * 1000, period))
+            for representation in range(representations):
+                parts.append('      <Representation id="{0}{1}" bandwidth="{2}"/>\n'
+                             .format(content_type, representation, 500000 * (representation + 1)))
+            parts.append('    </AdaptationSet>\n')
+        parts.append('  </Period>\n')
+    parts.append(MPD_TAIL)
+    return ''.join(parts)
+
+"""
+SegmentTimeline based MPD with `segments` segments per timeline. Every other segment
+gets its own <S> element so the timeline doesn't collapse into a single run.
+"""
+def timeline_mpd(segments, segment_duration=2, first_segment=0, periods=1, adaptation_sets=2, representations=4,
+                 time_shift_buffer_depth=30, availability_start_time='1970-01-01T00:00:00Z', publish_time=None):
+    timescale = 90000
+    d = segment_duration * timescale
+    parts = [MPD_HEAD.format(availability_start_time=availability_start_time,
+                             publish_time=publish_time or availability_start_time,
+                             segment_duration=xs_duration(segment_duration),
+                             time_shift_buffer_depth=xs_duration(time_shift_buffer_depth))]
+    for period in range(periods):
+        parts.append('  <Period id="p{0}" start="PT0S">\n'.format(period))
+        for adaptation_set in range(adaptation_sets):
+            content_type = 'video' if adaptation_set == 0 else 'audio'
+            parts.append('    <AdaptationSet id="{0}" contentType="{1}" segmentAlignment="true">\n'
+                         .format(adaptation_set, content_type))
+            parts.append('      <SegmentTemplate timescale="{0}" media="p{1}_$RepresentationID$_$Time$.m4s" '
+                         'initialization="p{1}_$RepresentationID$_init.mp4">\n'.format(timescale, period))
+            parts.append('        <SegmentTimeline>\n')
+            parts.append('          <S t="{0}" d="{1}"/>\n'.format(first_segment * d, d))
+            for segment in range(1, segments):
+                if segment % 2:
+                    parts.append('          <S d="{0}"/>\n'.format(d))
+                else:
+                    parts.append('          <S d="{0}" r="0"/>\n'.format(d))
+            parts.append('        </SegmentTimeline>\n')
+            parts.append('      </SegmentTemplate>\n')
+            for representation in range(representations):
+                parts.append('      <Representation id="{0}{1}" bandwidth="{2}"/>\n'
+                             .format(content_type, representation, 500000 * (representation + 1)))
+            parts.append('    </AdaptationSet>\n')
+        parts.append('  </Period>\n')
+    parts.append(MPD_TAIL)
+    return ''.join(parts)
@@ -0,0 +1,43 @@
+"""
+Benchmark of the segment name rendering: chained str.replace per segment, as the segment lists
+used to be built, against the compiled templates of SegmentResolver.
+
+Usage: python -m bench.template_bench [segments]
+"""
+import sys
+import time
+
+from dash.SegmentResolver import compile_template
+
+TEMPLATE = 'video/$RepresentationID$/$Bandwidth$/seg_$Number%05d$_$Time$.m4s'
+ROUNDS = 10
+
+
+def replace(template, representation_id, bandwidth, number, time):
+    name = template.replace("$RepresentationID$", representation_id)
+    name = name.replace("$Bandwidth$", str(bandwidth))
+    name = name.replace("$Number%05d$", '%05d' % number)
+    return name.replace("$Time$", str(time))
+
+
+def measure(render, segments):
+    started = time.time()
+    for _ in range(ROUNDS):
+        for number in xrange(segments):
+            render(number, number * 180000)
+    return (time.time() - started) / ROUNDS / segments
+
+
+def main():
+    segments = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    compiled = compile_template(TEMPLATE).bind(RepresentationID='v1', Bandwidth=5000000)
+    assert compiled.render(Number=7, Time=1260000) == replace(TEMPLATE, 'v1', 5000000, 7, 1260000)
+
+    baseline = measure(lambda number, t: replace(TEMPLATE, 'v1', 5000000, number, t), segments)
+    elapsed = measure(lambda number, t: compiled.render(Number=number, Time=t), segments)
+    print "{} segments, {}".format(segments, TEMPLATE)
+    print "str.replace: {:8.3f} us per segment (1.0x)".format(baseline * 1e6)
+    print "   compiled: {:8.3f} us per segment ({:.1f}x)".format(elapsed * 1e6, baseline / elapsed)
+
+if __name__ == '__main__':
+    main()
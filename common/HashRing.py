@@ -0,0 +1,37 @@
+import hashlib
+from bisect import bisect
+
+"""
+Consistent hashing of keys onto nodes. Every node is put on the ring `replicas` times
+so the keys spread evenly, and adding or removing a node only moves the keys of that node.
+"""
+class HashRing:
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.hashes = []
+        self.nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    def hash(self, key):
+        return int(hashlib.md5(str(key)).hexdigest()[:16], 16)
+
+    def add(self, node):
+        for replica in xrange(self.replicas):
+            point = self.hash('{}-{}'.format(node, replica))
+            if point not in self.nodes:
+                self.nodes[point] = node
+                self.hashes.insert(bisect(self.hashes, point), point)
+
+    def remove(self, node):
+        for replica in xrange(self.replicas):
+            point = self.hash('{}-{}'.format(node, replica))
+            if self.nodes.get(point) == node:
+                del self.nodes[point]
+                self.hashes.remove(point)
+
+    def get(self, key):
+        if not self.hashes:
+            return None
+        index = bisect(self.hashes, self.hash(key)) % len(self.hashes)
+        return self.nodes[self.hashes[index]]
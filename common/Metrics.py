@@ -0,0 +1,126 @@
+from twisted.internet import reactor
+from twisted.internet.task import cooperate, TaskStopped
+from twisted.web.resource import Resource
+
+from common.Statistic import Histogram, COUNTER, GAUGE, HISTOGRAM
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+"""
+Split a statistic key into its name and the labels part without braces
+"""
+def split_key(key):
+    if '{' not in key:
+        return key, ''
+    name, labels = key.split('{', 1)
+    return name, labels[:-1]
+
+_bucket_labels = {}
+
+"""
+le labels of the buckets of a histogram, +Inf included, built once per bucket bounds
+"""
+def bucket_labels(buckets):
+    labels = _bucket_labels.get(buckets)
+    if labels is None:
+        labels = _bucket_labels[buckets] = ['le="{}"'.format(bound) for bound in buckets] + ['le="+Inf"']
+    return labels
+
+"""
+Append the lines of the statistics in the Prometheus text exposition format to `lines`,
+yielding after every series so that the rendering can be spread over several reactor turns.
+Series removed in the meantime are left out.
+"""
+def prometheus_lines(stat, lines):
+    metrics = {}
+    for key in stat.data.keys():
+        name, labels = split_key(key)
+        metrics.setdefault(name, []).append((labels, key))
+
+    for name in sorted(metrics):
+        metric_type = stat.types.get(name)
+        lines.append('# TYPE {} {}'.format(name, metric_type if metric_type in (COUNTER, GAUGE, HISTOGRAM) else 'untyped'))
+        for labels, key in sorted(metrics[name]):
+            value = stat.data.get(key)
+            if value is None:
+                continue
+            if isinstance(value, Histogram):
+                prefix = name + '_bucket{' + (labels + ',' if labels else '')
+                cumulative = 0
+                for le, count in zip(bucket_labels(value.buckets), value.counts):
+                    cumulative += count
+                    lines.append('%s%s} %d' % (prefix, le, cumulative))
+                lines.append('{}_sum{} {}'.format(name, '{' + labels + '}' if labels else '', format_value(value.sum)))
+                lines.append('{}_count{} {}'.format(name, '{' + labels + '}' if labels else '', value.count))
+            else:
+                lines.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', format_value(value)))
+            yield
+
+"""
+Format the statistics in the Prometheus text exposition format
+"""
+def prometheus_text(stat):
+    lines = []
+    for _ in prometheus_lines(stat, lines):
+        pass
+    return '\n'.join(lines) + '\n'
+
+"""
+Web resource serving the statistics to Prometheus. The text is rendered every `interval`
+seconds, a few series per reactor turn, and the scrapes are served the last rendered text,
+so a scrape never blocks the reactor however many series there are. `refresh` is called
+before every rendering, e.g. to collect the statistics of the worker processes.
+"""
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, stat, refresh=None, interval=10):
+        Resource.__init__(self)
+        self.stat = stat
+        self.refresh = refresh
+        self.interval = interval
+        self.text = None
+        self.timer = None
+        self.rendering = None
+
+    def start(self):
+        self.update()
+
+    def stop(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        if self.rendering is not None:
+            self.rendering.stop()
+            self.rendering = None
+
+    def update(self):
+        self.timer = None
+        if self.refresh is not None:
+            self.refresh()
+        lines = []
+        self.rendering = cooperate(prometheus_lines(self.stat, lines))
+        d = self.rendering.whenDone()
+        d.addCallbacks(self.on_rendered, self.on_render_stopped, callbackArgs=(lines,))
+
+    def on_rendered(self, result, lines):
+        self.rendering = None
+        self.text = '\n'.join(lines) + '\n'
+        self.timer = reactor.callLater(self.interval, self.update)
+
+    def on_render_stopped(self, reason):
+        reason.trap(TaskStopped)
+
+    def render_GET(self, request):
+        if self.text is None:
+            # not rendered yet
+            if self.refresh is not None:
+                self.refresh()
+            self.text = prometheus_text(self.stat)
+        request.setHeader('Content-Type', CONTENT_TYPE)
+        return self.text
@@ -0,0 +1,48 @@
+from collections import deque
+
+from twisted.internet import defer
+from twisted.internet import reactor
+
+"""
+Token bucket limiting the throughput to `rate` units per second.
+A request is allowed as soon as the bucket is not in debt and the amount is taken
+at once, so a request bigger than the bucket just makes the next ones wait longer.
+"""
+class TokenBucket:
+    def __init__(self, rate, burst=None, clock=reactor):
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock.seconds()
+        self.waiting = deque()
+        self.timer = None
+
+    def refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    """
+    Returns a Deferred which fires when the amount can be sent.
+    """
+    def consume(self, amount):
+        d = defer.Deferred()
+        self.waiting.append((amount, d))
+        self.release()
+        return d
+
+    def release(self):
+        self.refill()
+        while self.waiting and self.tokens >= 0:
+            amount, d = self.waiting.popleft()
+            self.tokens -= amount
+            d.callback(amount)
+        if self.waiting and self.timer is None:
+            self.timer = self.clock.callLater(-self.tokens / self.rate, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.release()
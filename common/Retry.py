@@ -0,0 +1,114 @@
+import random
+from collections import deque
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+
+"""
+Exponential backoff with jitter. The n-th retry waits base_delay * 2^n seconds,
+capped to max_delay, minus a random part of up to `jitter` of it.
+"""
+class RetryPolicy:
+    def __init__(self, max_attempts=4, base_delay=0.5, max_delay=8, jitter=0.5):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, retry_count):
+        delay = min(self.max_delay, self.base_delay * (2 ** retry_count))
+        return delay * (1 - self.jitter * random.random())
+
+"""
+Call `call` (which returns a Deferred) until it succeeds, the attempts of the policy are
+used up or the next attempt would start after `deadline` (in reactor seconds).
+on_retry is called with the failure before every retry.
+"""
+def retry(call, policy, deadline=None, on_retry=None, clock=reactor):
+    result = defer.Deferred()
+
+    def attempt(retry_count):
+        d = call()
+        d.addCallbacks(result.callback, on_failure, errbackArgs=(retry_count,))
+
+    def on_failure(reason, retry_count):
+        delay = policy.delay(retry_count)
+        if retry_count + 1 >= policy.max_attempts or \
+                (deadline is not None and clock.seconds() + delay > deadline):
+            result.errback(reason)
+            return
+        if on_retry is not None:
+            on_retry(reason)
+        task.deferLater(clock, delay, attempt, retry_count + 1)
+
+    attempt(0)
+    return result
+
+"""
+Keeps the latencies of the last `size` requests to estimate the given percentile.
+"""
+class LatencyTracker:
+    def __init__(self, size=200, percentile=0.95, min_samples=20):
+        self.samples = deque(maxlen=size)
+        self.percentile = percentile
+        self.min_samples = min_samples
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    """
+    Returns the latency percentile or None when there are not enough samples yet.
+    """
+    def threshold(self):
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+
+"""
+Call `call` and, if it hasn't finished within the latency threshold of the tracker,
+send a second (hedged) request. The first success wins and the other one is cancelled.
+on_hedge is called when the second request is sent.
+"""
+def hedged(call, tracker, on_hedge=None, clock=reactor):
+    threshold = tracker.threshold()
+    result = defer.Deferred()
+    state = {'pending': 0, 'timer': None}
+    requests = []
+
+    def cancel_timer():
+        if state['timer'] is not None and state['timer'].active():
+            state['timer'].cancel()
+
+    def on_success(data, started):
+        tracker.record(clock.seconds() - started)
+        state['pending'] -= 1
+        if not result.called:
+            cancel_timer()
+            result.callback(data)
+            for d in requests:
+                if not d.called:
+                    d.cancel()
+
+    def on_failure(reason):
+        state['pending'] -= 1
+        if not result.called and state['pending'] == 0:
+            cancel_timer()
+            result.errback(reason)
+
+    def start():
+        state['pending'] += 1
+        d = call()
+        requests.append(d)
+        d.addCallbacks(on_success, on_failure, callbackArgs=(clock.seconds(),))
+
+    def hedge():
+        if on_hedge is not None:
+            on_hedge()
+        start()
+
+    start()
+    if threshold is not None and not result.called:
+        state['timer'] = clock.callLater(threshold, hedge)
+    return result
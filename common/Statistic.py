@@ -1,29 +1,227 @@
+from bisect import bisect_left
 
+import math
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+"""
+Bucket bounds growing by the same factor from `lowest` to at least `highest`, so that the
+relative error of a percentile is the same at every scale (2^(1/4), i.e. 19%, by default)
+"""
+def log_buckets(lowest, highest, per_doubling=4):
+    count = int(math.ceil(math.log(float(highest) / lowest, 2) * per_doubling)) + 1
+    return tuple(float('%.6g' % (lowest * 2 ** (float(i) / per_doubling))) for i in xrange(count))
+
+# upper bounds in seconds, from 1ms to 10 minutes
+DEFAULT_BUCKETS = log_buckets(0.001, 600)
+# the same range doubling at every bucket, for the histograms kept per destination whose
+# number of series multiplies the size of the exported metrics
+COARSE_BUCKETS = log_buckets(0.001, 600, per_doubling=1)
+
+"""
+Escape a label value as the Prometheus text format requires
+"""
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+"""
+Build the key of a labelled statistic, e.g. uploaded_bytes{destination="http://..."}
+"""
+def stat_key(name, labels):
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, escape_label_value(labels[k])) for k in sorted(labels)))
+
+"""
+Distribution of observed values (e.g. latencies) in fixed buckets, so it takes the same
+memory however many values are observed.
+counts[i] is the number of values not greater than buckets[i] (and greater than the
+previous bound); the last one counts the values above all the bounds.
+"""
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        if other.buckets != self.buckets:
+            raise ValueError("Histograms with different buckets can't be merged")
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    """
+    Estimate the value under which `ratio` (0.0 to 1.0) of the values are, interpolating
+    linearly within the bucket like Prometheus' histogram_quantile does
+    """
+    def percentile(self, ratio):
+        if self.count == 0:
+            return None
+        rank = ratio * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if index == len(self.buckets):
+                    return self.max
+                lower = self.buckets[index - 1] if index > 0 else 0
+                upper = min(self.buckets[index], self.max)
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.max
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': self.counts, 'sum': self.sum, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, value):
+        histogram = cls(tuple(value['buckets']))
+        histogram.counts = list(value['counts'])
+        histogram.count = sum(histogram.counts)
+        histogram.sum = value['sum']
+        histogram.max = value['max']
+        return histogram
+
+    def __repr__(self):
+        if self.count == 0:
+            return 'Histogram(count=0)'
+        return 'Histogram(count={}, p50={:.3f}, p95={:.3f}, p99={:.3f}, max={:.3f})'.format(
+            self.count, self.percentile(0.5), self.percentile(0.95), self.percentile(0.99), self.max)
+
+"""
+Counters (append/increase), gauges (set) and histograms (observe) keyed by name and labels.
+The type of each name is kept for exporting them.
+"""
 class Statistics:
     def __init__(self):
         self.data = {}
+        self.types = {}
 
-    def append(self, name, amount):
-        if name not in self.data.keys():
-            self.data[name] = 0
-        self.data[name] += amount
+    def append(self, name, amount, **labels):
+        key = stat_key(name, labels)
+        if key not in self.data:
+            self.types[name] = COUNTER
+            self.data[key] = 0
+        self.data[key] += amount
 
-    def increase(self, name):
-        if name not in self.data.keys():
-            self.data[name] = 0
-        self.data[name] += 1
+    def increase(self, name, **labels):
+        self.append(name, 1, **labels)
 
-    def get(self, name):
-        return self.data[name]
+    def get(self, name, **labels):
+        return self.data[stat_key(name, labels)]
 
-    def getMB(self, name):
-        if self.data[name] == 0:
+    def getMB(self, name, **labels):
+        if self.get(name, **labels) == 0:
             return 0
         else:
-            return self.data[name] / 1048576
+            return self.get(name, **labels) / 1048576
+
+    def set(self, name, value, **labels):
+        self.types[name] = GAUGE
+        self.data[stat_key(name, labels)] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = stat_key(name, labels)
+        if key not in self.data:
+            self.types[name] = HISTOGRAM
+            self.data[key] = Histogram(buckets)
+        self.data[key].observe(value)
+
+    def percentile(self, name, ratio, **labels):
+        return self.data[stat_key(name, labels)].percentile(ratio)
 
-    def set(self, name, value):
-        self.data[name] = value
+    """
+    JSON serializable copy of the values, to be merged into another Statistics
+    """
+    def snapshot(self):
+        data = dict((key, value.to_dict() if isinstance(value, Histogram) else value)
+                    for key, value in self.data.items())
+        return {'types': self.types, 'data': data}
+
+    """
+    Add the values of a snapshot to this one
+    """
+    def merge(self, snapshot):
+        # json gives unicode
+        for name, metric_type in snapshot['types'].items():
+            self.types[str(name)] = str(metric_type)
+        for key, value in snapshot['data'].items():
+            key = str(key)
+            if isinstance(value, dict):
+                histogram = Histogram.from_dict(value)
+                if key in self.data:
+                    self.data[key].merge(histogram)
+                else:
+                    self.data[key] = histogram
+            else:
+                self.data[key] = self.data.get(key, 0) + value
 
     def __str__(self):
         return str(self.data)
+
+    """
+    Statistics of a part of the process, e.g. a channel. Every value is labelled with the
+    given labels and stored in this one.
+    """
+    def scope(self, **labels):
+        return ScopedStatistics(self, labels)
+
+class ScopedStatistics:
+    def __init__(self, parent, labels):
+        self.parent = parent
+        self.labels = labels
+
+    def merge_labels(self, labels):
+        merged = dict(self.labels)
+        merged.update(labels)
+        return merged
+
+    def append(self, name, amount, **labels):
+        self.parent.append(name, amount, **self.merge_labels(labels))
+
+    def increase(self, name, **labels):
+        self.parent.increase(name, **self.merge_labels(labels))
+
+    def get(self, name, **labels):
+        return self.parent.get(name, **self.merge_labels(labels))
+
+    def getMB(self, name, **labels):
+        return self.parent.getMB(name, **self.merge_labels(labels))
+
+    def set(self, name, value, **labels):
+        self.parent.set(name, value, **self.merge_labels(labels))
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        self.parent.observe(name, value, buckets, **self.merge_labels(labels))
+
+    def percentile(self, name, ratio, **labels):
+        return self.parent.percentile(name, ratio, **self.merge_labels(labels))
+
+    def scope(self, **labels):
+        return ScopedStatistics(self.parent, self.merge_labels(labels))
+
+    def keys(self):
+        labels = [stat_key('', {k: v}).strip('{}') for k, v in self.labels.items()]
+        return [key for key in self.parent.data if all(label in key for label in labels)]
+
+    """
+    Remove every value of this scope, e.g. when the channel is removed
+    """
+    def clear(self):
+        for key in self.keys():
+            del self.parent.data[key]
+
+    def __str__(self):
+        return str(dict((key, self.parent.data[key]) for key in self.keys()))
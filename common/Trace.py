@@ -0,0 +1,152 @@
+import json
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+
+import logging
+logger = logging.getLogger(__name__)
+
+# events after which a destination has nothing more to do with the segment
+FINAL_EVENTS = ('upload_end', 'upload_failed', 'dropped')
+
+"""
+Follows each media segment through the pipeline and records when it reached every step:
+discovered, download_start, download_end, enqueued, round_start, and upload_start,
+upload_end, upload_failed or dropped for each destination (download_failed ends the trace).
+A trace is finished when every expected destination is done with the segment, or after
+`max_age` seconds (e.g. the segment failed to download or was evicted). Finished traces are
+kept in a ring buffer of `size` traces and appended to `path` as JSON lines if it is given.
+Listeners are called with every finished trace.
+"""
+class Tracer:
+    def __init__(self, size=10000, path=None, max_age=300):
+        self.traces = deque(maxlen=size)
+        self.path = path
+        self.max_age = max_age
+        # (labels, segment) -> trace of the segments in the pipeline
+        self.active = {}
+        self.last_expire = 0
+        self.file = open(path, 'a') if path else None
+        self.listeners = []
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def key(self, labels, segment):
+        return tuple(sorted(labels.items())), segment
+
+    def begin(self, segment, labels):
+        now = reactor.seconds()
+        self.expire(now)
+        trace = dict(labels)
+        trace.update({'segment': segment, 'discovered': now, 'destinations': {}, 'expected': None})
+        self.active[self.key(labels, segment)] = trace
+
+    def mark(self, segment, event, labels, destination=None):
+        trace = self.active.get(self.key(labels, segment))
+        if trace is None:
+            return
+        if destination is None:
+            trace[event] = reactor.seconds()
+            return
+        trace['destinations'].setdefault(destination, {})[event] = reactor.seconds()
+        if event in FINAL_EVENTS:
+            self.check_completion(labels, segment, trace)
+
+    """
+    Set the destinations the segment is going to be uploaded to
+    """
+    def expect(self, segment, destinations, labels):
+        trace = self.active.get(self.key(labels, segment))
+        if trace is not None:
+            trace['expected'] = list(destinations)
+
+    def check_completion(self, labels, segment, trace):
+        if trace['expected'] is None:
+            return
+        for destination in trace['expected']:
+            events = trace['destinations'].get(destination, {})
+            if not any(event in events for event in FINAL_EVENTS):
+                return
+        self.finish(labels, segment)
+
+    def finish(self, labels, segment):
+        trace = self.active.pop(self.key(labels, segment), None)
+        if trace is None:
+            return
+        del trace['expected']
+        self.add(trace)
+
+    """
+    Keep a finished trace, e.g. one forwarded by a worker process
+    """
+    def add(self, trace):
+        self.traces.append(trace)
+        if self.file is not None:
+            self.file.write(json.dumps(trace) + '\n')
+            self.file.flush()
+        for listener in self.listeners:
+            listener(trace)
+
+    """
+    Finish the traces which are in the pipeline for too long
+    """
+    def expire(self, now):
+        if now - self.last_expire < 1:
+            return
+        self.last_expire = now
+        for (labels, segment), trace in self.active.items():
+            if now - trace['discovered'] > self.max_age:
+                trace['expired'] = now
+                self.finish(dict(labels), segment)
+
+    def scope(self, **labels):
+        return ScopedTracer(self, labels)
+
+"""
+Tracer of a part of the process, e.g. a channel. Every trace is labelled with the given labels.
+"""
+class ScopedTracer:
+    def __init__(self, tracer, labels):
+        self.tracer = tracer
+        self.labels = labels
+
+    def begin(self, segment):
+        self.tracer.begin(segment, self.labels)
+
+    def mark(self, segment, event, destination=None):
+        self.tracer.mark(segment, event, self.labels, destination)
+
+    def expect(self, segment, destinations):
+        self.tracer.expect(segment, destinations, self.labels)
+
+    def finish(self, segment):
+        self.tracer.finish(self.labels, segment)
+
+"""
+Web resource serving the finished traces as JSON lines, newest last.
+Query arguments: segment (only the traces of the segments containing it) and limit.
+"""
+class TraceResource(Resource):
+    isLeaf = True
+
+    def __init__(self, tracer):
+        Resource.__init__(self)
+        self.tracer = tracer
+
+    def render_GET(self, request):
+        segment = request.args.get('segment', [None])[0]
+        try:
+            limit = int(request.args.get('limit', [1000])[0])
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            request.setResponseCode(400)
+            request.setHeader('Content-Type', 'text/plain')
+            return 'limit must be a non-negative integer\n'
+        traces = [trace for trace in self.tracer.traces if segment is None or segment in trace['segment']]
+        # the newest `limit` ones
+        traces = traces[max(0, len(traces) - limit):]
+        request.setHeader('Content-Type', 'application/x-ndjson')
+        return ''.join(json.dumps(trace) + '\n' for trace in traces)
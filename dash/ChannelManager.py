@@ -0,0 +1,192 @@
+import json
+import os
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore
+
+from dash.DashPuller import DashPuller
+from dash.DashPusher import DashPusher
+from dash.SegmentCache import SegmentCache
+from common.Retry import RetryPolicy
+
+import logging
+logger = logging.getLogger(__name__)
+
+# settings of the ChannelManager which apply to all of its channels
+SHARED_SETTINGS = ('max_inflight',)
+
+"""
+One replicated channel: the puller of its source and the pusher to its destinations.
+`settings` is a dict with the same keys as the command line options.
+Its statistics (and traces, if a tracer is given) are labelled with the channel name.
+If upload_semaphore is given, it bounds the uploads of this channel together with the
+other channels sharing it, in place of a semaphore of max_inflight of its own.
+"""
+class Channel:
+    def __init__(self, name, settings, stat, tracer=None, upload_semaphore=None):
+        self.name = name
+        self.settings = settings
+        self.upload_semaphore = upload_semaphore
+        self.stat = stat.scope(channel=name)
+        self.tracer = tracer.scope(channel=name) if tracer is not None else None
+        self.puller = None
+        self.pusher = None
+
+    def start(self):
+        settings = self.settings
+        if not settings['source'].endswith(".mpd"):
+            # later other protocol could be added.
+            raise ValueError("Not supported input: {}".format(settings['source']))
+
+        retry_policy = RetryPolicy(max_attempts=settings['retries'] + 1)
+        cache = None
+        if settings['cache_dir']:
+            cache = SegmentCache(os.path.join(settings['cache_dir'], self.name), self.stat,
+                                 settings['cache_retention'])
+        self.puller = DashPuller(settings['source'], stat=self.stat, retry_policy=retry_policy, hedge=settings['hedge'],
+                                 max_parallel_downloads=settings['max_parallel_downloads'],
+                                 buffer_size=settings['buffer_size'] * 1048576,
+                                 eviction_policy=settings['eviction_policy'], cache=cache, tracer=self.tracer)
+
+        self.pusher = DashPusher(settings['destination'], self.puller.consume, self.stat,
+                                 mpd_repeat=settings['mpd_repeat'], init_segment_repeat=settings['init_repeat'],
+                                 delete_after=settings['delete_after'], relay=settings['relay'],
+                                 window=settings['window'], max_lag=settings['max_lag'],
+                                 max_inflight_per_destination=settings['max_inflight_per_destination'],
+                                 max_inflight=settings['max_inflight'], global_semaphore=self.upload_semaphore,
+                                 rate_limit=settings['rate_limit'], retry_policy=retry_policy, tracer=self.tracer,
+                                 store=self.puller.media_segments)
+        if settings['relay']:
+            self.puller.relay = self.pusher.relay_segment
+        self.puller.add_listener(self.pusher.notify)
+        self.pusher.add_release_listener(self.puller.on_released)
+
+        logger.info("[%s] Start replicating %s to %s", self.name, settings['source'], settings['destination'])
+        self.puller.start()
+        self.pusher.start()
+
+    def stop(self):
+        logger.info("[%s] Stop replicating %s", self.name, self.settings['source'])
+        if self.puller is not None:
+            self.puller.stop()
+        if self.pusher is not None:
+            self.pusher.stop()
+
+"""
+Runs the channels listed in a JSON config file in this process:
+
+    {"channels": {"news": {"source": "http://origin/news/live.mpd",
+                           "destination": ["http://ingest/news/"],
+                           "mpd_repeat": 1, "init_repeat": 5, "delete_after": 60}}}
+
+Any command line option can be overridden per channel; the others are taken from `defaults`.
+The file is checked every `reload_interval` seconds (and on reload()): added channels are
+started, removed ones stopped and the changed ones restarted. All the channels share the
+connection pool, `stat`, `tracer` and the max_inflight uploads, which is why max_inflight
+can't be overridden per channel.
+Without config_path the channels are only given through apply().
+"""
+class ChannelManager:
+    def __init__(self, config_path, defaults, stat, reload_interval=5, tracer=None):
+        self.config_path = config_path
+        self.defaults = defaults
+        self.stat = stat
+        self.tracer = tracer
+        self.reload_interval = reload_interval
+        max_inflight = defaults.get('max_inflight')
+        self.upload_semaphore = DeferredSemaphore(max_inflight) if max_inflight else None
+        self.channels = {}
+        self.config_mtime = None
+        self.timer = None
+
+    def start(self):
+        if self.config_path is None:
+            return
+        self.reload()
+        self.timer = reactor.callLater(self.reload_interval, self.run)
+
+    def stop(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        for name in self.channels.keys():
+            self.remove_channel(name)
+
+    def run(self):
+        try:
+            mtime = os.path.getmtime(self.config_path)
+        except OSError as e:
+            logger.error("Failed to check %s: %s", self.config_path, e)
+        else:
+            if mtime != self.config_mtime:
+                self.reload()
+        self.timer = reactor.callLater(self.reload_interval, self.run)
+
+    def read_config(self):
+        with open(self.config_path) as f:
+            return json.load(f)
+
+    """
+    Returns the settings of each channel of the config
+    """
+    def load_channels(self, config):
+        channels = {}
+        for name, overrides in config.get('channels', {}).items():
+            settings = dict(self.defaults)
+            for key, value in overrides.items():
+                if key not in settings:
+                    raise ValueError("Unknown setting of channel {}: {}".format(name, key))
+                if key in SHARED_SETTINGS:
+                    raise ValueError("{} is shared by all the channels and can't be set for channel {}".format(key, name))
+                # json gives unicode but urls are used as byte strings
+                settings[key] = value.encode('utf-8') if isinstance(value, unicode) else value
+            if isinstance(settings['destination'], (str, unicode)):
+                settings['destination'] = [settings['destination']]
+            settings['destination'] = [str(destination) for destination in settings['destination'] or []]
+            if not settings['source'] or not settings['destination']:
+                raise ValueError("Channel {} needs a source and a destination".format(name))
+            channels[str(name)] = settings
+        return channels
+
+    def reload(self):
+        try:
+            self.config_mtime = os.path.getmtime(self.config_path)
+            self.configure(self.read_config())
+        except (IOError, OSError, ValueError) as e:
+            # keep running the current channels
+            logger.error("Failed to load %s: %s", self.config_path, e)
+
+    def configure(self, config):
+        self.apply(self.load_channels(config))
+
+    """
+    Start, stop and restart the channels to run the given ones
+    """
+    def apply(self, channels):
+        for name in self.channels.keys():
+            if name not in channels:
+                self.remove_channel(name)
+        for name, settings in sorted(channels.items()):
+            if name in self.channels:
+                if self.channels[name].settings == settings:
+                    continue
+                logger.info("[%s] Settings are changed. Restart the channel.", name)
+                self.remove_channel(name)
+            self.add_channel(name, settings)
+        self.stat.set('channel_count', len(self.channels))
+
+    def add_channel(self, name, settings):
+        channel = Channel(name, settings, self.stat, self.tracer, self.upload_semaphore)
+        try:
+            channel.start()
+        except (ValueError, OSError) as e:
+            logger.error("[%s] Failed to start: %s", name, e)
+            channel.stop()
+            return
+        self.channels[name] = channel
+
+    def remove_channel(self, name):
+        channel = self.channels.pop(name)
+        channel.stop()
+        # the statistics are dropped; pending deletions of the channel are still counted until they are done
+        channel.stat.clear()
@@ -1,79 +1,332 @@
+import calendar
+import hashlib
+import re
+import time
 from datetime import datetime, timedelta
+from collections import deque
 from functools import partial
 from urlparse import urljoin
 
 from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore
+from twisted.python.failure import Failure
 
 from HttpHelper import getResource
+from HttpHelper import getConditionalResource
 from mpd.parser import MPDParser
+from mpd.utils import ParseOptions, parse_duration
+from common.Retry import RetryPolicy, LatencyTracker, retry, hedged
+from common.Statistic import Statistics
+from SegmentStore import SegmentStore, DROP_OLDEST
+from SegmentResolver import SEGMENT_TEMPLATE, SEGMENT_LIST, SEGMENT_BASE
+from SegmentResolver import resolve_active_periods
 
 import logging
 logger = logging.getLogger(__name__)
 
-def str_to_seconds(time_string):
-    time_string = time_string.replace(".0S", "S")
-    td = datetime.strptime(time_string, 'PT%HH%MM%SS') - datetime(1900, 1, 1)
-    return td.total_seconds()
+"""
+Seconds of an xs:duration, either as parsed in the MPD nodes or as a string, e.g. PT1M30.5S
+"""
+def str_to_seconds(duration):
+    if isinstance(duration, basestring):
+        duration = parse_duration(duration)
+    return float(duration)
+
+DATETIME_PATTERN = re.compile(r'(\d+-\d+-\d+T\d+:\d+:\d+)(\.\d+)?(Z|[+-]\d+:\d+)?$')
+
+"""
+Convert an xs:dateTime (e.g. availabilityStartTime) to seconds since the epoch.
+A time without a time zone is taken as UTC.
+"""
+def datetime_to_seconds(datetime_string):
+    match = DATETIME_PATTERN.match(datetime_string.strip())
+    if match is None:
+        raise ValueError("Invalid xs:dateTime: {}".format(datetime_string))
+    seconds = calendar.timegm(datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S').timetuple())
+    if match.group(2):
+        seconds += float(match.group(2))
+    zone = match.group(3)
+    if zone and zone != 'Z':
+        hours, minutes = zone[1:].split(':')
+        offset = int(hours) * 3600 + int(minutes) * 60
+        seconds += -offset if zone[0] == '+' else offset
+    return seconds
 
 """
-Interprets MPD and extracts the last segment list and other useful information
+The elements of the MPD used by MPDInterpreter. The other ones (ProgramInformation, descriptors,
+EventStream, SubRepresentation...) are not parsed, and the periods and adaptation sets are only
+parsed when they are looked at, e.g. the timelines of the past periods are skipped.
+"""
+REPLICATION_PROJECTION = ParseOptions(tags=['Period', 'AdaptationSet', 'Representation', 'BaseURL',
+                                            'SegmentTemplate', 'SegmentTimeline', 'SegmentList', 'SegmentURL',
+                                            'SegmentBase', 'Initialization'], lazy=True)
+
+"""
+Interprets MPD and extracts the new segment list and other useful information
+Every period which still has segments in the time shift buffer is looked at, and the segments
+of each representation are resolved with SegmentTemplate, SegmentList or SegmentBase along the
+Period, AdaptationSet and Representation inheritance and BaseURL chain (see SegmentResolver).
+A cursor is kept per representation so each refresh yields exactly the segments which are
+new since the previous one, as far back as the time shift buffer goes. The segments are
+grouped by their position, oldest group first, and every group has one segment per representation.
+The periods appearing after the first MPD are taken from their start, so no segment is lost
+at a period boundary (e.g. ad insertion).
 """
 class MPDInterpreter:
+    parse_options = REPLICATION_PROJECTION
+
     # Constructor
     def __init__(self, mpd_path, raw_mpd):
         self.mpd_path = mpd_path
         self.segmentDuration = 0
         self.initSegments = []
-        self.mediaSegments = []
+        self.mediaSegmentGroups = []
+        # segment name -> bandwidth of its representation, for the segments of mediaSegmentGroups
+        self.segmentBandwidths = {}
+        # segment name -> time (seconds since the epoch) the segment becomes available on the origin
+        self.segmentAvailability = {}
+        # segment name -> URL to download it from, for initSegments and mediaSegmentGroups
+        self.segmentUrls = {}
+        # (period id, representation id) -> start time of the last segment taken from the timeline
+        self.timelineCursors = {}
+        # (period id, representation id) -> number of the last segment taken from the template or list
+        self.numberCursors = {}
+        # only the newest segments are taken from the first MPD
+        self.first_refresh = True
         self.update_mpd(raw_mpd)
 
     def update_mpd(self, raw_mpd):
-        self.mpd = MPDParser.parse(raw_mpd)
+        self.mpd = MPDParser.parse(raw_mpd, options=self.parse_options)
         self.refresh_interval = str_to_seconds(self.mpd.minimum_update_period)
+        self.availabilityStartTime = self.get_availability_start_time()
+        # period key -> addressing of its representations, for this MPD version
+        self.resolved = {}
+        self.refresh()
+
+    """
+    Look for new segments in the current MPD. The live edge of a $Number$ template without
+    Period@duration (or of an open timeline run) moves with the clock, so an unchanged MPD
+    can still have new segments.
+    """
+    def refresh(self):
+        self.periods = self.get_active_periods()
         self.segmentDuration = self.get_segment_duration()
+        self.availabilityWindow = self.get_availability_window()
 
-        if len(self.initSegments) == 0:
-            self.createInitSegmentList()
+        self.segmentUrls = {}
+        self.createInitSegmentList()
         self.createLastSegmentList()
 
-    # segment duration based on "video" content in the first period.
+    # segment duration based on "video" content, else on any content, of the active periods
     def get_segment_duration(self):
-        # segment duration based on "video" content in the first period.
-        for period in self.mpd.periods:
-            for adaptationSet in period.adaptation_sets:
-                if adaptationSet.content_type == "video":
-                    if(adaptationSet.segment_templates):
-                        return adaptationSet.segment_templates[0].duration / adaptationSet.segment_templates[0].timescale
+        representations = [addressing for active in self.periods for addressing in active.representations]
+        representations.sort(key=lambda addressing: addressing.content_type != "video")
+        for addressing in representations:
+            duration = addressing.segment_duration()
+            if duration:
+                return duration
+        return self.refresh_interval
+
+    # None if the MPD has no (valid) availabilityStartTime
+    def get_availability_start_time(self):
+        if self.mpd.availability_start_time:
+            try:
+                return datetime_to_seconds(self.mpd.availability_start_time)
+            except ValueError:
+                logger.warning("Invalid availabilityStartTime: %s", self.mpd.availability_start_time)
+        return None
+
+    def get_active_periods(self):
+        live_edge = time.time() - self.availabilityStartTime if self.availabilityStartTime is not None else None
+        depth = str_to_seconds(self.mpd.time_shift_buffer_depth) if self.mpd.time_shift_buffer_depth is not None else 0
+        return resolve_active_periods(self.mpd_path, self.mpd, live_edge, depth, self.resolved)
+
+    """
+    Time a segment ending at `end` (in seconds of the period) becomes available on the origin
+    """
+    def segment_available_at(self, active, end):
+        if self.availabilityStartTime is None:
+            return None
+        return self.availabilityStartTime + active.start + end
+
+    # how long a segment stays available on the origin after it is published
+    def get_availability_window(self):
+        if self.mpd.time_shift_buffer_depth is not None:
+            try:
+                return str_to_seconds(self.mpd.time_shift_buffer_depth)
+            except ValueError:
+                pass
+        return self.segmentDuration
 
+    # init segments of the active periods
     def createInitSegmentList(self):
         self.initSegments = []
-        if len(self.mpd.periods) > 0:
-            period = self.mpd.periods[-1]
-            for adaptationSet in period.adaptation_sets:
-                if adaptationSet.segment_templates:
-                    initializationFormat = adaptationSet.segment_templates[0].initialization
-                    for representation in adaptationSet.representations:
-                        self.initSegments.append(initializationFormat.replace("$RepresentationID$", representation.id))
+        for active in self.periods:
+            for addressing in active.representations:
+                segment = addressing.initialization_segment()
+                if segment is not None and segment[0] not in self.segmentUrls:
+                    self.initSegments.append(segment[0])
+                    self.segmentUrls[segment[0]] = segment[1]
 
     def createLastSegmentList(self):
-        self.mediaSegments = []
-        if len(self.mpd.periods) > 0:
-            period = self.mpd.periods[-1]
-            periodDuration = str_to_seconds(period.duration)
-            for adaptationSet in period.adaptation_sets:
-                if adaptationSet.segment_templates:
-                    segmentDuration = adaptationSet.segment_templates[0].duration / adaptationSet.segment_templates[0].timescale
-                    lastSegmentNumber = int(periodDuration / segmentDuration)
-                    mediaFormat = adaptationSet.segment_templates[0].media
-                    for representation in adaptationSet.representations:
-                        self.mediaSegments.append(mediaFormat.replace("$RepresentationID$", representation.id).replace("$Number$", str(lastSegmentNumber)))
+        self.segmentBandwidths = {}
+        self.segmentAvailability = {}
+        self.mediaSegmentGroups = []
+        keys = set()
+        for index, active in enumerate(self.periods):
+            # new segment names of each representation, oldest first
+            segment_lists = []
+            for addressing in active.representations:
+                keys.add(addressing.key)
+                segment_lists.append(self.createSegmentList(active, addressing))
+            if self.first_refresh and index < len(self.periods) - 1:
+                # only the cursors of the past periods are set the first time
+                continue
+
+            # align the lists at the newest segment and group them by position
+            group_count = max([len(segment_list) for segment_list in segment_lists] or [0])
+            groups = [[] for _ in xrange(group_count)]
+            for segment_list in segment_lists:
+                offset = group_count - len(segment_list)
+                for position, name in enumerate(segment_list):
+                    groups[offset + position].append(name)
+            self.mediaSegmentGroups.extend(groups)
+        self.first_refresh = False
+
+        # forget the representations of the periods which are gone
+        for cursors in (self.timelineCursors, self.numberCursors):
+            for key in cursors.keys():
+                if key not in keys:
+                    del cursors[key]
+
+    def createSegmentList(self, active, addressing):
+        if addressing.kind == SEGMENT_TEMPLATE:
+            if addressing.timeline is not None:
+                return self.createTimelineSegmentList(active, addressing)
+            if addressing.duration:
+                return self.createNumberSegmentList(active, addressing)
+        elif addressing.kind == SEGMENT_LIST:
+            return self.createListSegmentList(active, addressing)
+        elif addressing.kind == SEGMENT_BASE:
+            return self.createBaseSegmentList(active, addressing)
+        return []
+
+    def add_segment(self, addressing, path, available):
+        name, url = addressing.locate(path)
+        self.segmentBandwidths[name] = addressing.bandwidth
+        self.segmentAvailability[name] = available
+        self.segmentUrls[name] = url
+        return name
+
+    """
+    Numbers of the new segments of a representation whose last segment is `last`. The first
+    time, only the newest segment is taken, or every segment of the time shift buffer if the
+    representation appeared after the first MPD.
+    """
+    def new_numbers(self, addressing, last, segment_duration):
+        oldest = last - int(self.availabilityWindow / segment_duration) + 1 if segment_duration else addressing.start_number
+        cursor = self.numberCursors.get(addressing.key)
+        if cursor is None and not self.first_refresh:
+            first = max(oldest, addressing.start_number)
+        elif cursor is None or last < cursor:
+            # first refresh, or the numbering went backwards (e.g. encoder restart)
+            first = last
+        else:
+            first = max(cursor + 1, oldest)
+        self.numberCursors[addressing.key] = last
+        return xrange(first, last + 1)
+
+    """
+    New segments of a $Number$ template with a fixed duration. The live edge is at the end of
+    the period, or at the current time while the period has no duration.
+    """
+    def createNumberSegmentList(self, active, addressing):
+        if active.elapsed is None:
+            return []
+        segmentDuration = float(addressing.duration) / addressing.timescale
+        lastSegmentNumber = addressing.start_number + int(active.elapsed / segmentDuration) - 1
+        if lastSegmentNumber < addressing.start_number:
+            return []
+        segment_list = []
+        for number in self.new_numbers(addressing, lastSegmentNumber, segmentDuration):
+            segment_list.append(self.add_segment(
+                addressing, addressing.media_name(number=number),
+                self.segment_available_at(active, (number - addressing.start_number + 1) * segmentDuration)))
+        return segment_list
+
+    """
+    New segments of a SegmentTimeline template since the last refresh. The first time, only
+    the newest segment is taken, or every segment of the time shift buffer if the
+    representation appeared after the first MPD.
+    """
+    def createTimelineSegmentList(self, active, addressing):
+        timescale = addressing.timescale
+        # an open run (r="-1") at the end of the timeline repeats up to the live edge
+        end = None
+        if active.elapsed is not None:
+            end = int(active.elapsed * timescale) + addressing.presentation_time_offset
+        last_segment = addressing.timeline_index.last_segment(end)
+        if last_segment is None:
+            return []
+        cursor = self.timelineCursors.get(addressing.key)
+        if cursor is None and not self.first_refresh:
+            new_segments = addressing.timeline_index.segments(end=end)
+        elif cursor is None or last_segment[0] < cursor:
+            # first refresh, or the timeline went backwards (e.g. encoder restart)
+            new_segments = [last_segment]
+        else:
+            new_segments = addressing.timeline_index.segments(cursor, end)
+        oldest = time.time() - self.availabilityWindow
+        segment_list = []
+        for segment_time, number, duration in new_segments:
+            available = self.segment_available_at(
+                active, float(segment_time + duration - addressing.presentation_time_offset) / timescale)
+            if cursor is None and available is not None and available < oldest:
+                continue
+            segment_list.append(self.add_segment(
+                addressing, addressing.media_name(number=number, time=segment_time), available))
+        if new_segments:
+            self.timelineCursors[addressing.key] = new_segments[-1][0]
+        return segment_list
+
+    """
+    New segments of a SegmentList. Segments which are byte ranges of the same resource are
+    replicated as that whole resource, once.
+    """
+    def createListSegmentList(self, active, addressing):
+        if not addressing.segment_urls:
+            return []
+        segmentDuration = float(addressing.duration) / addressing.timescale if addressing.duration else None
+        lastSegmentNumber = addressing.start_number + len(addressing.segment_urls) - 1
+        segment_list = []
+        for number in self.new_numbers(addressing, lastSegmentNumber, segmentDuration):
+            segment_url = addressing.segment_urls[number - addressing.start_number]
+            available = None
+            if segmentDuration is not None:
+                available = self.segment_available_at(active, (number - addressing.start_number + 1) * segmentDuration)
+            name = self.add_segment(addressing, segment_url.media or '', available)
+            if name not in segment_list:
+                segment_list.append(name)
+        return segment_list
+
+    """
+    A SegmentBase representation is a single resource (the byte ranges are in it), taken once.
+    """
+    def createBaseSegmentList(self, active, addressing):
+        if addressing.key in self.numberCursors or addressing.base_url == self.mpd_path:
+            return []
+        self.numberCursors[addressing.key] = 1
+        available = None
+        if active.elapsed is not None:
+            available = self.segment_available_at(active, active.elapsed)
+        return [self.add_segment(addressing, '', available)]
 
 
 """
 Group downloader. created per group and deleted when the mission is completed
 """
 class GroupDownloader:
-    def __init__(self, path, sink, file_list):
+    def __init__(self, path, sink, file_list, fetch, urls=None):
         self.path = path
         self.sink = sink
         self.count = len(file_list)
@@ -81,10 +334,12 @@ class GroupDownloader:
         self.downloaded_list = []
         logger.debug("Initiate group downloading: %s files", len(file_list))
         for filename in file_list:
-            url = urljoin(self.path, filename)
+            url = urls[filename] if urls and filename in urls else urljoin(self.path, filename)
             logger.debug("Start downloading segments: %s", url)
-            d = getResource(url)
+            d = fetch(filename, url)
             d.addCallbacks(partial(self.on_download, filename), partial(self.on_err, filename))
+        if self.count == 0:
+            self.check_completion()
 
     def on_download(self, filename, data):
         self.downloaded_list.append([filename, data])
@@ -104,36 +359,147 @@ class GroupDownloader:
     Check the completion and deliver the download files
     """
     def check_completion(self):
-        if self.count + self.error_count == len(self.downloaded_list):
+        if self.count == len(self.downloaded_list) + self.error_count:
             logger.debug("Downloading is completed with {} success and {} failure".format(len(self.downloaded_list), self.error_count))
             self.sink(self.downloaded_list)
 
 """
 Drive downloading MPD and segment files in asynchrnous way
 Keeps the downloaded files until they are consumed but will discarse oldest one if buffer got too big
+If relay is given, media segments are downloaded by calling relay(filename, url) which
+pushes them to the destinations while they are downloaded (cut-through relay mode)
+Failed downloads are retried with exponential backoff within the availability window of the
+segments and, if hedge is set, a second request is sent when a download is slower than 95% of
+the recent ones.
+The MPD is requested with If-None-Match/If-Modified-Since and it is parsed only when its
+content has changed.
+Every segment missed since the last refresh is downloaded, at most max_parallel_downloads
+at a time, and the packages are delivered in order.
+The packages wait for the pusher in a SegmentStore of buffer_size bytes.
+If cache is given, media segments are written to the SegmentCache and only kept on the disk.
+The packages left in the cache by the previous run are resumed on start.
+If tracer is given, media segments are traced from their discovery to their enqueueing.
 """
 class DashPuller:
-    def __init__(self, path):
+    def __init__(self, path, relay=None, stat=None, retry_policy=None, hedge=False, max_parallel_downloads=16,
+                 buffer_size=512 * 1048576, eviction_policy=DROP_OLDEST, cache=None, tracer=None):
         logger.info("DashPuller created")
         self.mpd_path = path
+        self.relay = relay
+        self.stat = stat if stat is not None else Statistics()
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.hedge = hedge
+        self.cache = cache
+        self.tracer = tracer
+        self.latency = LatencyTracker()
+        self.download_semaphore = DeferredSemaphore(max_parallel_downloads)
+        # [completed, files, bandwidths, available] of the media groups being downloaded, in order
+        self.pending_groups = deque()
+        self.mpd_failure_count = 0
         self.mpd_name = path.split("/")[-1]
         self.raw_mpd = ""
         self.mpd_int = None
+        self.mpd_etag = None
+        self.mpd_last_modified = None
+        self.mpd_hash = None
+        self.mpd_refresh_count = 0
+        self.mpd_not_modified_count = 0
+        self.mpd_parse_skip_count = 0
         self.refresh_interval = 0
         self.last_update = None
+        self.timer = None
+        self.stopped = False
 
-        # Collect init segments once and then reuse
+        # Collect init segments once and then reuse. New ones (e.g. of a new period) are
+        # collected when they appear and handed over with the next package.
         self.init_segments = []
-        self.media_segments = []
+        self.init_requested = set()
+        self.init_changed = False
+        self.media_segments = SegmentStore(buffer_size, self.stat, eviction_policy)
+        # callbacks notified when a new media segment package is delivered
+        self.listeners = []
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
 
     def start(self):
         logger.info("Start pulling %s", self.mpd_path)
+        if self.cache is not None:
+            for media_segment_list, bandwidths in self.cache.resume():
+                self.media_segments.append(media_segment_list, bandwidths)
+            self.cache.start()
         self.get_mpd()
 
     def on_mpd_error(self, reason):
+        delay = self.retry_policy.delay(self.mpd_failure_count)
+        self.mpd_failure_count += 1
+        self.stat.increase('mpd_failure_count')
         logger.error("Failed downloading mpd: %s ", reason)
-        logger.error("Retey after 5 seconds.")
-        reactor.callLater(5, self.start)
+        logger.error("Retry after %.1f seconds.", delay)
+        # the refreshes are aligned again from the next successful one
+        self.last_update = None
+        if not self.stopped:
+            self.timer = reactor.callLater(delay, self.get_mpd)
+
+    """
+    Download a segment. Retries until the segment is not available anymore, that is
+    availabilityWindow after it became available (after now if that is unknown).
+    """
+    def download(self, filename, url):
+        def on_retry(reason):
+            logger.warning("Retry downloading %s: %s", url, reason.getErrorMessage())
+            self.stat.increase('download_retry_count')
+
+        def on_hedge():
+            logger.debug("Send hedged request for %s", url)
+            self.stat.increase('hedged_request_count')
+
+        def attempt():
+            if self.hedge:
+                return hedged(partial(getResource, url), self.latency, on_hedge)
+            return getResource(url)
+
+        available = self.mpd_int.segmentAvailability.get(filename)
+        deadline = (available if available is not None else reactor.seconds()) + self.mpd_int.availabilityWindow
+        return retry(attempt, self.retry_policy, deadline, on_retry)
+
+    def fetch_media(self, filename, url):
+        if self.relay is not None:
+            relay = partial(self.relay, available=self.mpd_int.segmentAvailability.get(filename))
+            d = self.download_semaphore.run(self.timed_fetch, relay, filename, url)
+        else:
+            d = self.download_semaphore.run(self.timed_fetch, self.download, filename, url)
+        d.addCallbacks(self.on_media_downloaded, self.on_media_failure, errbackArgs=(filename,))
+        return d
+
+    """
+    Fetch with `fetch` and record how long it took, retries included but not the wait for the semaphore
+    """
+    def timed_fetch(self, fetch, filename, url):
+        started_at = reactor.seconds()
+        if self.tracer is not None:
+            self.tracer.mark(filename, 'download_start')
+        d = fetch(filename, url)
+        d.addCallback(self.on_fetched, filename, started_at)
+        return d
+
+    def on_fetched(self, data, filename, started_at):
+        self.stat.observe('download_seconds', reactor.seconds() - started_at)
+        if self.tracer is not None:
+            self.tracer.mark(filename, 'download_end')
+        return data
+
+    def on_media_downloaded(self, data):
+        self.stat.append('downloaded_bytes', len(data))
+        self.stat.increase('downloaded_file_count')
+        return data
+
+    def on_media_failure(self, reason, filename):
+        self.stat.increase('download_failure_count')
+        if self.tracer is not None:
+            self.tracer.mark(filename, 'download_failed')
+            self.tracer.finish(filename)
+        return reason
 
     def get_mpd(self):
         logger.debug("Start dowlnoading MPD: {}".format(self.mpd_path))
@@ -144,20 +510,81 @@ class DashPuller:
         else:
             self.last_update = self.last_update + timedelta(seconds=self.mpd_int.segmentDuration)
         # trigger async download
-        d = getResource(self.mpd_path)
+        requested_at = reactor.seconds()
+        d = getConditionalResource(self.mpd_path, self.mpd_etag, self.mpd_last_modified)
+        d.addCallback(self.on_mpd_response, requested_at)
         d.addCallbacks(self.on_mpd, self.on_mpd_error)
 
+    def on_mpd_response(self, response, requested_at):
+        self.stat.observe('mpd_refresh_seconds', reactor.seconds() - requested_at)
+        return response
+
     def stop(self):
-        logger.debug("Stop pulling", self.mpd_path)
+        logger.info("Stop pulling %s", self.mpd_path)
+        self.stopped = True
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        if self.cache is not None:
+            self.cache.stop()
+        self.listeners = []
+
+    """
+    Parse and update the MPD if it has changed. Returns True if it has. An unchanged MPD is not
+    parsed again but still looked at for new segments.
+    """
+    def update_mpd(self, response):
+        self.mpd_refresh_count += 1
+        self.stat.increase('mpd_refresh_count')
+        if not response.modified:
+            logger.debug("Not modified: {}".format(self.mpd_path))
+            self.mpd_not_modified_count += 1
+            self.stat.increase('mpd_not_modified_count')
+            self.refresh_mpd()
+            return False
+
+        logger.debug("Downloaded: {} (size={})".format(self.mpd_path, len(response.data)))
+        self.mpd_etag = response.etag
+        self.mpd_last_modified = response.last_modified
+        mpd_hash = hashlib.sha1(response.data).digest()
+        if mpd_hash == self.mpd_hash:
+            logger.debug("Unchanged: {}".format(self.mpd_path))
+            self.mpd_parse_skip_count += 1
+            self.stat.increase('mpd_parse_skip_count')
+            self.refresh_mpd()
+            return False
 
-    def on_mpd(self, data):
-        logger.debug("Downloaded: {} (size={})".format(self.mpd_path, len(data)))
-        # Parse and update the MPD
-        self.raw_mpd = data
+        self.mpd_hash = mpd_hash
+        self.raw_mpd = response.data
         if self.mpd_int is None:
-            self.mpd_int = MPDInterpreter(self.mpd_path, str(data))
+            self.mpd_int = MPDInterpreter(self.mpd_path, str(response.data))
         else:
-            self.mpd_int.update_mpd(str(data))
+            self.mpd_int.update_mpd(str(response.data))
+        return True
+
+    def refresh_mpd(self):
+        if self.mpd_int is not None:
+            self.mpd_int.refresh()
+
+    def update_mpd_rates(self):
+        refresh_count = float(self.mpd_refresh_count)
+        self.stat.set('mpd_not_modified_rate', self.mpd_not_modified_count / refresh_count)
+        self.stat.set('mpd_parse_skip_rate', (self.mpd_not_modified_count + self.mpd_parse_skip_count) / refresh_count)
+
+    def on_mpd(self, response):
+        if self.stopped:
+            return
+        try:
+            self.update_mpd(response)
+        except Exception:
+            # e.g. a broken MPD. Try again as if the download failed.
+            self.stat.increase('mpd_parse_failure_count')
+            # parse it again even if it comes back unchanged
+            self.mpd_hash = self.mpd_etag = self.mpd_last_modified = None
+            self.on_mpd_error(Failure())
+            return
+        self.mpd_failure_count = 0
+        self.update_mpd_rates()
 
         # reserve the next MPD update
         # Here the delay is deducted from the chunk duration in order to
@@ -165,42 +592,99 @@ class DashPuller:
         # less than second delay will be not a big deal because in get_mpd, "last_update"
         # is updated based on "segmentDuration", not "now()" so last_update will be always
         # aligned to the segmentDuration slots
-        mpdDownloadDelay = (datetime.now() - self.last_update).seconds
-        remainingDuration = self.mpd_int.segmentDuration - mpdDownloadDelay
-        reactor.callLater(remainingDuration, self.get_mpd)
+        mpdDownloadDelay = (datetime.now() - self.last_update).total_seconds()
+        remainingDuration = max(0, self.mpd_int.segmentDuration - mpdDownloadDelay)
+        self.timer = reactor.callLater(remainingDuration, self.get_mpd)
 
-        # download init segment if not there
-        if len(self.mpd_int.initSegments) > 0:
-            if len(self.init_segments) == 0:
-                GroupDownloader(self.mpd_path, self.init_segment_collector, self.mpd_int.initSegments)
+        # download the init segments which are not there yet
+        self.init_requested &= set(self.mpd_int.initSegments)
+        new_init_segments = [name for name in self.mpd_int.initSegments if name not in self.init_requested]
+        if new_init_segments:
+            self.init_requested.update(new_init_segments)
+            GroupDownloader(self.mpd_path, partial(self.init_segment_collector, new_init_segments),
+                            new_init_segments, self.download, self.mpd_int.segmentUrls)
 
         # download media segments for this round
-        if len(self.mpd_int.mediaSegments) > 0:
-            GroupDownloader(self.mpd_path, self.media_segment_collector, self.mpd_int.mediaSegments)
+        if len(self.mpd_int.mediaSegmentGroups) > 1:
+            logger.info("Catching up %d segment groups", len(self.mpd_int.mediaSegmentGroups))
+        for media_segments in self.mpd_int.mediaSegmentGroups:
+            if self.tracer is not None:
+                for name in media_segments:
+                    self.tracer.begin(name)
+            bandwidths = dict((name, self.mpd_int.segmentBandwidths.get(name)) for name in media_segments)
+            available = dict((name, self.mpd_int.segmentAvailability.get(name)) for name in media_segments)
+            group = [False, None, bandwidths, available]
+            self.pending_groups.append(group)
+            GroupDownloader(self.mpd_path, partial(self.media_group_collector, group), media_segments,
+                            self.fetch_media, self.mpd_int.segmentUrls)
 
-    def init_segment_collector(self, init_segment_list):
-        self.init_segments = init_segment_list
+    """
+    Keep the init segments of the current MPD. The ones which failed are requested again with the next MPD.
+    """
+    def init_segment_collector(self, requested, init_segment_list):
+        current = set(self.mpd_int.initSegments)
+        self.init_segments = [segment for segment in self.init_segments if segment[0] in current] + init_segment_list
+        downloaded = set(name for name, _ in init_segment_list)
+        self.init_requested.difference_update(name for name in requested if name not in downloaded)
+        self.init_changed = True
         logger.info("Init segments are ready.")
 
-    def media_segment_collector(self, media_segment_list):
-        if len(self.media_segments) > 3:
-            logger.debug("Too many media segment packages are in the queue. Clear all.")
-            del media_segment_list[:]
+    """
+    Deliver the downloaded groups in the order they were discovered
+    """
+    def media_group_collector(self, group, media_segment_list):
+        group[0] = True
+        group[1] = media_segment_list
+        while self.pending_groups and self.pending_groups[0][0]:
+            _, media_segment_list, bandwidths, available = self.pending_groups.popleft()
+            self.media_segment_collector(media_segment_list, bandwidths, available)
+
+    def media_segment_collector(self, media_segment_list, bandwidths=None, available=None):
         logger.debug("New media segment package with {} files is delivered.".format(len(media_segment_list)))
-        self.media_segments.append(media_segment_list)
+        if self.tracer is not None:
+            for filename, _ in media_segment_list:
+                self.tracer.mark(filename, 'enqueued')
+        if self.cache is not None:
+            d = self.cache.store(media_segment_list, bandwidths)
+            d.addErrback(self.on_cache_error, media_segment_list)
+            d.addCallback(self.enqueue, bandwidths, available)
+            return
+        self.enqueue(media_segment_list, bandwidths, available)
+
+    def on_cache_error(self, reason, media_segment_list):
+        logger.error("Failed to write the package to the cache: %s. Keep it in memory.", reason.getErrorMessage())
+        self.stat.increase('segment_cache_failure_count')
+        return media_segment_list
+
+    def enqueue(self, media_segment_list, bandwidths=None, available=None):
+        self.media_segments.append(media_segment_list, bandwidths, available)
+        for listener in self.listeners:
+            listener()
+
+    """
+    Called with the media files of a package once every destination is done with it
+    """
+    def on_released(self, media_list):
+        if self.cache is not None:
+            self.cache.consumed(media_list)
 
     def consume(self, includeIndex = False, includeMPD = False):
         mpd_list = []
         init_list = []
         media_list = []
+        available = {}
         if len(self.media_segments) > 0:
-            if includeIndex is True:
+            if includeIndex is True or self.init_changed:
                 init_list = self.init_segments
-            if includeMPD is True:
+                self.init_changed = False
+            # nothing to send before the first MPD when resuming from the cache
+            if includeMPD is True and self.raw_mpd:
                 mpd_list.append([self.mpd_name, self.raw_mpd])
-            media_list = self.media_segments.pop(0)
+            media_list, available = self.media_segments.pop()
+            if self.cache is not None:
+                self.cache.take(media_list)
 
         from collections import namedtuple
-        DashFile = namedtuple("DashFile", "mpd init media")
-        files = DashFile(mpd_list, init_list, media_list)
+        DashFile = namedtuple("DashFile", "mpd init media available")
+        files = DashFile(mpd_list, init_list, media_list, available)
         return files
\ No newline at end of file
@@ -1,138 +1,458 @@
-from datetime import datetime, timedelta
+from collections import deque
+from datetime import datetime
 from functools import partial
+from heapq import heappush, heappop
+from itertools import count
 from urlparse import urljoin
 
 from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore
 
 from dash.HttpHelper import postResource
 from dash.HttpHelper import deleteResource
+from dash.HttpHelper import relayResource
+from dash.SegmentStore import memory_size
+from common.RateLimit import TokenBucket
+from common.Statistic import COARSE_BUCKETS
+from common.Retry import RetryPolicy, retry
 
 import logging
 logger = logging.getLogger(__name__)
 
 # DeletionManager
+# Keeps the uploaded files in a heap ordered by their expiry time and deletes the expired
+# ones on its own timer, at most max_concurrent at a time. Failed deletions are retried.
 class DeletionManager:
-    def __init__(self, delete_after):
+    def __init__(self, delete_after, stat, interval=1, max_concurrent=10, max_attempts=3, retry_delay=5):
         self.deleteAfter = delete_after
+        self.stat = stat
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.semaphore = DeferredSemaphore(max_concurrent)
+        # (expire, sequence, path, attempt)
         self.waiting_list = []
+        self.sequence = count()
+        self.on_fly_count = 0
+        self.timer = None
+        self.finishing = False
+
+    def start(self):
+        self.timer = reactor.callLater(self.interval, self.run)
 
-    def append(self, path):
-        from collections import namedtuple
-        DeleteItem = namedtuple("DeleteItem", "path expire")
-        expire_time = datetime.now() + timedelta(seconds=self.deleteAfter)
-        self.waiting_list.append(DeleteItem(path, expire_time))
+    def stop(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+    def run(self):
+        self.delete_expired_files()
+        if self.finishing and not self.waiting_list and self.on_fly_count == 0:
+            self.timer = None
+            return
+        self.timer = reactor.callLater(self.interval, self.run)
+
+    """
+    Stop the timer once every file waiting for deletion is deleted
+    """
+    def finish(self):
+        self.finishing = True
+
+    def append(self, path, delay=None, attempt=0):
+        expire_time = reactor.seconds() + (self.deleteAfter if delay is None else delay)
+        heappush(self.waiting_list, (expire_time, next(self.sequence), path, attempt))
+        self.update_backlog()
+
+    def update_backlog(self):
+        self.stat.set('deletion_backlog', len(self.waiting_list) + self.on_fly_count)
 
     def delete_expired_files(self):
-        while len(self.waiting_list) > 0 and self.waiting_list[0].expire < datetime.now():
-            file_to_delete = self.waiting_list.pop(0)
-            if file_to_delete.expire < datetime.now():
-                logger.debug("Delete expired files: ", file_to_delete.path)
-
-                def success(result):
-                    pass
-
-                def failure(err):
-                    pass
-                d = deleteResource(file_to_delete.path)
-                # adding the callback but the callbacks will do nothing
-                # don't care deletion's result.
-                d.addCallbacks(success, failure)
-            else:
-                break
+        now = reactor.seconds()
+        while self.waiting_list and self.waiting_list[0][0] <= now:
+            expire_time, _, path, attempt = heappop(self.waiting_list)
+            logger.debug("Delete expired files: %s", path)
+            self.on_fly_count += 1
+            d = self.semaphore.run(deleteResource, path)
+            d.addCallbacks(self.on_deleted, self.on_delete_failure, errbackArgs=(path, attempt))
+        self.update_backlog()
+
+    def on_deleted(self, result):
+        self.on_fly_count -= 1
+        self.stat.increase('deleted_file_count')
+        self.update_backlog()
+
+    def on_delete_failure(self, reason, path, attempt):
+        self.on_fly_count -= 1
+        self.stat.increase('deletion_failure_count')
+        if attempt + 1 < self.max_attempts:
+            logger.warning("Failed to delete %s: %s. Retry later.", path, reason.getErrorMessage())
+            self.append(path, self.retry_delay, attempt + 1)
+        else:
+            logger.error("Failed to delete %s: %s", path, reason.getErrorMessage())
+            self.update_backlog()
+
+"""
+Upload pipeline of one destination. Has its own queue of packages and uploads up to
+`window` packages at the same time, so a slow destination never holds back the others.
+If the destination falls more than `max_lag` packages behind, it skips to the newest one.
+At most `max_inflight` files are uploaded at the same time (and no more than the shared
+`global_semaphore` allows) and the upload throughput is capped to `rate_limit` bytes per second.
+Failed uploads are retried following `retry_policy`.
+If tracer is given, the uploads of media segments are traced.
+Packages are queued with a token which is handed to on_done once the package is uploaded or dropped.
+"""
+class DestinationPipeline:
+    def __init__(self, destination, stat, deleter, relay=False, window=1, max_lag=15,
+                 max_inflight=None, global_semaphore=None, rate_limit=None, retry_policy=None, tracer=None,
+                 on_done=None):
+        self.destination = destination
+        self.stat = stat
+        self.deleter = deleter
+        self.relay = relay
+        self.window = window
+        self.max_lag = max_lag
+        self.on_done = on_done
+        # (token, file_list)
+        self.queue = deque()
+        self.round = 0
+        self.on_fly_package_count = 0
+        self.semaphore = DeferredSemaphore(max_inflight) if max_inflight else None
+        self.global_semaphore = global_semaphore
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.tracer = tracer
+
+    def trace(self, filename, event):
+        if self.tracer is not None:
+            self.tracer.mark(filename, event, self.destination)
+
+    def done(self, token):
+        if self.on_done is not None:
+            self.on_done(token)
+
+    def push(self, token, file_list):
+        self.queue.append((token, file_list))
+        if len(self.queue) > self.max_lag:
+            self.skip_to_newest()
+        self.update_lag()
+        self.pump()
+
+    """
+    Drop all the queued packages but the newest one. mpd and init segments of the dropped
+    packages are carried over if the newest package doesn't have them.
+    """
+    def skip_to_newest(self):
+        token, newest = self.queue.pop()
+        while self.queue:
+            dropped_token, dropped = self.queue.pop()
+            if not newest.mpd and dropped.mpd:
+                newest = newest._replace(mpd=dropped.mpd)
+            if not newest.init and dropped.init:
+                newest = newest._replace(init=dropped.init)
+            self.stat.increase('dropped_package_count', destination=self.destination)
+            for filename, _ in dropped.media:
+                self.trace(filename, 'dropped')
+            self.done(dropped_token)
+        logger.warning("[%s] Too far behind. Skip to the newest package.", self.destination)
+        self.queue.append((token, newest))
+
+    """
+    Called when the queued packages are over the budget of the segment store
+    """
+    def shed(self):
+        if len(self.queue) > 1:
+            self.skip_to_newest()
+            self.update_lag()
+
+    def update_lag(self):
+        self.stat.set('destination_lag', len(self.queue) + self.on_fly_package_count, destination=self.destination)
+
+    def pump(self):
+        while self.queue and self.on_fly_package_count < self.window:
+            self.upload(*self.queue.popleft())
+        self.update_lag()
+
+    def upload(self, token, file_list):
+        self.round += 1
+        package_round = self.round
+        started_at = datetime.now()
+        files = []
+        for filename, buffer in file_list.mpd:
+            files.append((filename, buffer, False))
+        for filename, buffer in file_list.init:
+            files.append((filename, buffer, False))
+        if not self.relay:
+            for filename, buffer in file_list.media:
+                files.append((filename, buffer, True))
+        if not files:
+            self.done(token)
+            return
+
+        logger.info("[%s round %d] Start uploading %d mpd, %d init segments, %d media segments", self.destination,
+                    package_round, len(file_list.mpd), len(file_list.init), 0 if self.relay else len(file_list.media))
+        self.on_fly_package_count += 1
+        state = {'on_fly_file_count': len(files)}
+
+        def check_completion():
+            state['on_fly_file_count'] -= 1
+            if state['on_fly_file_count'] == 0:
+                delta = datetime.now() - started_at
+                logger.info("[%s round %d] Files are uploaded. Elapsed time: %f",
+                            self.destination, package_round, delta.total_seconds())
+                self.stat.increase('uploading_round', destination=self.destination)
+                self.stat.observe('upload_round_seconds', delta.total_seconds(), COARSE_BUCKETS,
+                                  destination=self.destination)
+                self.stat.append('total_uploading_time', delta.total_seconds(), destination=self.destination)
+                self.stat.set('avg_uploading_time',
+                              self.stat.get('total_uploading_time', destination=self.destination) /
+                              self.stat.get('uploading_round', destination=self.destination),
+                              destination=self.destination)
+                self.on_fly_package_count -= 1
+                self.done(token)
+                self.pump()
+
+        def on_upload(path, filename, bytes, need_to_delete, result):
+            logger.debug("Uploaded: %s ", path)
+            available_at = file_list.available.get(filename)
+            if available_at is not None:
+                # from the origin making the segment available to the destination having it
+                self.stat.observe('availability_delay_seconds', reactor.seconds() - available_at, COARSE_BUCKETS,
+                                  destination=self.destination)
+            self.stat.append('uploaded_bytes', bytes, destination=self.destination)
+            self.stat.increase('uploaded_file_count', destination=self.destination)
+            if need_to_delete:
+                self.deleter.append(path)
+                self.trace(filename, 'upload_end')
+            check_completion()
+
+        def on_fail(path, filename, need_to_delete, reason):
+            logger.error("Failed to upload: %s %s", path, str(reason))
+            self.stat.increase('uploading_failure_count', destination=self.destination)
+            if need_to_delete:
+                self.trace(filename, 'upload_failed')
+            check_completion()
+
+        for filename, buffer, need_to_delete in files:
+            url = urljoin(self.destination, filename)
+            if need_to_delete:
+                self.trace(filename, 'upload_start')
+            d = self.post(url, buffer)
+            d.addCallbacks(partial(on_upload, url, filename, len(buffer), need_to_delete),
+                           partial(on_fail, url, filename, need_to_delete))
+
+    """
+    Upload a file once the concurrency limits and the rate limit allow it.
+    Every attempt waits for the rate limit before it takes a slot of the shared global_semaphore,
+    and gives the slot back when it fails, so a throttled destination or one waiting to retry
+    doesn't hold slots the other destinations could use.
+    """
+    def post(self, url, buffer):
+        if self.semaphore is not None:
+            return self.semaphore.run(self.post_retrying, url, buffer)
+        return self.post_retrying(url, buffer)
+
+    def post_retrying(self, url, buffer):
+        def on_retry(reason):
+            logger.warning("Retry uploading %s: %s", url, reason.getErrorMessage())
+            self.stat.increase('upload_retry_count', destination=self.destination)
+
+        def on_posted(result):
+            self.stat.observe('upload_seconds', reactor.seconds() - started_at, COARSE_BUCKETS,
+                              destination=self.destination)
+            return result
+
+        started_at = reactor.seconds()
+        d = retry(partial(self.post_throttled, url, buffer), self.retry_policy, on_retry=on_retry)
+        d.addCallback(on_posted)
+        return d
+
+    def post_throttled(self, url, buffer):
+        if self.bucket is not None:
+            d = self.bucket.consume(len(buffer))
+            d.addCallback(lambda _: self.post_global(url, buffer))
+            return d
+        return self.post_global(url, buffer)
+
+    def post_global(self, url, buffer):
+        if self.global_semaphore is not None:
+            return self.global_semaphore.run(postResource, url, buffer)
+        return postResource(url, buffer)
 
 # Data Pusher
+# Every package taken from the source is handed to the pipeline of each destination.
+# In relay mode media segments are already pushed by relay_segment while they are
+# downloaded, so the pipelines only upload mpd and init segments. Relayed uploads are
+# not subject to the concurrency and rate limits since they must start with the download.
+# If tracer is given, media segments are traced until every destination has them.
+# Uploads are bounded by global_semaphore if given (e.g. shared with other pushers), else by max_inflight.
+# If store is given (the SegmentStore of the source), the media segments queued by the
+# pipelines are held against its budget until every pipeline is done with them, and the
+# pipelines skip to their newest package when the store is over budget.
+# The release listeners are told when every destination is done with a package.
 class DashPusher:
-    def __init__(self, destinations, source, stat, mpd_repeat=1, init_segment_repeat=5, delete_after=60):
+    def __init__(self, destinations, source, stat, mpd_repeat=1, init_segment_repeat=5, delete_after=60, relay=False,
+                 polling_interval=5, window=1, max_lag=15, max_inflight_per_destination=None, max_inflight=None,
+                 global_semaphore=None, rate_limit=None, retry_policy=None, tracer=None, store=None):
         if not destinations:
             raise ValueError("No destination is given")
 
         self.destinations = destinations
         self.source = source
         self.stat = stat
-        self.pollingInterval = 1
+        # rounds are started when the source notifies. polling is only a fallback.
+        self.pollingInterval = polling_interval
         self.init_segment_repeat = init_segment_repeat
         self.mpd_repeat = mpd_repeat
         self.round = 0
-        self.deleter = DeletionManager(delete_after)
-
-        # round can start when this variable is 0
-        self.on_fly_file_count = 0
-        # timestamp of the start of current round
-        self.round_started_at = None
+        self.relay = relay
+        self.deleter = DeletionManager(delete_after, stat)
+        if global_semaphore is None and max_inflight:
+            global_semaphore = DeferredSemaphore(max_inflight)
+        self.semaphore = global_semaphore
+        self.timer = None
+        self.tracer = tracer
+        self.store = store
+        # token -> [held bytes, pipelines not done with the package yet, media files]
+        self.held = {}
+        # callbacks called with the media files of a package once every pipeline is done with it
+        self.release_listeners = []
+        self.tokens = count()
+        self.pipelines = [DestinationPipeline(destination, stat, self.deleter, relay, window, max_lag,
+                                              max_inflight_per_destination, self.semaphore, rate_limit, retry_policy,
+                                              tracer, self.release)
+                          for destination in destinations]
+        if store is not None:
+            store.on_over_budget = self.shed
 
     def start(self):
-        reactor.callLater(self.pollingInterval, self.round_runner)
+        self.deleter.start()
+        self.timer = reactor.callLater(self.pollingInterval, self.round_runner)
+
+    """
+    Stop taking packages from the source. The uploaded files are still deleted when they expire.
+    """
+    def stop(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        self.deleter.finish()
 
     def start_new_round(self, file_list):
         # Increase round
         self.round += 1
-        self.round_started_at = datetime.now()
         self.stat.increase('total_uploading_round')
-        logger.info("[round %d] Start uploading %d mpd, %d init segments, %d media segments to %d destinations",
-                    self.round, len(file_list.mpd), len(file_list.init), len(file_list.media), len(self.destinations))
-        def check_completion():
-            self.on_fly_file_count -= 1
-            if self.on_fly_file_count == 0:
-                delta = datetime.now()-self.round_started_at
-                logger.info("[round %d] Files are successfully uploaded. Elapsed time: %f",
-                            self.round, delta.total_seconds())
-                self.stat.append('total_uploading_time', delta.total_seconds())
-                self.stat.set('avg_uploading_time', self.stat.get('total_uploading_time')/self.round)
-                logger.info(self.stat)
-
-        def on_upload(path, bytes, need_to_delete, result):
-            logger.debug("Uploaded: %s ", path)
-            self.stat.append('uploaded_bytes', bytes)
-            self.stat.increase('uploaded_file_count')
-            if need_to_delete:
-                self.deleter.append(path)
-            check_completion()
+        logger.debug("[round %d] New package with %d mpd, %d init segments, %d media segments",
+                     self.round, len(file_list.mpd), len(file_list.init), len(file_list.media))
+        if self.tracer is not None:
+            for filename, _ in file_list.media:
+                self.tracer.mark(filename, 'round_start')
+                if not self.relay:
+                    self.tracer.expect(filename, self.destinations)
+        token = next(self.tokens)
+        size = 0
+        if self.store is not None and not self.relay:
+            size = sum(memory_size(buffer) for _, buffer in file_list.media)
+        # one more so the package isn't released before it is held
+        self.held[token] = [size, len(self.pipelines) + 1, file_list.media]
+        for pipeline in self.pipelines:
+            pipeline.push(token, file_list)
+        if size:
+            # after the push, so shedding keeps this package as the newest one
+            self.store.hold(size)
+        self.release(token)
 
-        def on_fail(path, reason):
-            logger.error("Failed to upload: %s %s", path, str(reason))
-            self.stat.increase('uploading_failure_count')
-            check_completion()
+    def add_release_listener(self, callback):
+        self.release_listeners.append(callback)
 
-        """
-        replicate the uploading for all destinations
-        """
-        for destination in self.destinations:
-            for filename, buffer in file_list.mpd:
-                url = urljoin(destination, filename)
-                d = postResource(url, buffer)
-                d.addCallbacks(partial(on_upload, url, len(buffer), False), partial(on_fail, url))
-                self.on_fly_file_count += 1
-            for filename, buffer in file_list.init:
-                url = urljoin(destination, filename)
-                d = postResource(url, buffer)
-                d.addCallbacks(partial(on_upload, url, len(buffer), False), partial(on_fail, url))
-                self.on_fly_file_count += 1
-            for filename, buffer in file_list.media:
-                url = urljoin(destination, filename)
-                d = postResource(url, buffer)
-                d.addCallbacks(partial(on_upload, url, len(buffer), True), partial(on_fail, url))
-                self.on_fly_file_count += 1
+    def release(self, token):
+        held = self.held.get(token)
+        if held is None:
+            return
+        held[1] -= 1
+        if held[1] == 0:
+            del self.held[token]
+            size, _, media = held
+            if size:
+                self.store.release(size)
+            for listener in self.release_listeners:
+                listener(media)
 
     """
-    Async function polling the source. so as soon as the source is available
-    they will be uploaded
+    Drop the packages queued by the pipelines but their newest ones
     """
-    def round_runner(self):
-        # Only start a round or deletion when there is no file being uploaded
-        if self.on_fly_file_count == 0:
+    def shed(self):
+        for pipeline in self.pipelines:
+            pipeline.shed()
+
+    """
+    Download the segment from url and upload it to all destinations at the same time.
+    `available` is the time the segment became available on the origin, if known.
+    Returns the download Deferred.
+    """
+    def relay_segment(self, filename, url, available=None):
+        paths = [urljoin(destination, filename) for destination in self.destinations]
+        started_at = reactor.seconds()
+        d, uploads = relayResource(url, paths)
+        if self.tracer is not None:
+            self.tracer.expect(filename, self.destinations)
+            for destination in self.destinations:
+                self.tracer.mark(filename, 'upload_start', destination)
+        for destination, path, upload in zip(self.destinations, paths, uploads):
+            upload.addCallbacks(partial(self.on_relayed, destination, filename, path, started_at, available),
+                                partial(self.on_relay_fail, destination, filename, path))
+        return d
+
+    def on_relayed(self, destination, filename, path, started_at, available, bytes):
+        logger.debug("Relayed: %s ", path)
+        if self.tracer is not None:
+            self.tracer.mark(filename, 'upload_end', destination)
+        now = reactor.seconds()
+        self.stat.observe('upload_seconds', now - started_at, COARSE_BUCKETS, destination=destination)
+        if available is not None:
+            self.stat.observe('availability_delay_seconds', now - available, COARSE_BUCKETS, destination=destination)
+        self.stat.append('uploaded_bytes', bytes, destination=destination)
+        self.stat.increase('uploaded_file_count', destination=destination)
+        self.deleter.append(path)
+
+    def on_relay_fail(self, destination, filename, path, reason):
+        logger.error("Failed to relay: %s %s", path, str(reason))
+        if self.tracer is not None:
+            self.tracer.mark(filename, 'upload_failed', destination)
+        self.stat.increase('uploading_failure_count', destination=destination)
+
+    """
+    Called by the source when new files are ready to be uploaded.
+    """
+    def notify(self):
+        self.try_new_round()
+
+    """
+    Hand every package the source has over to the destination pipelines.
+    """
+    def try_new_round(self):
+        consumed = 0
+        while True:
             # Decide which file to download
             getMPD = True if self.round % self.mpd_repeat == 0 else False
             getInit = True if self.round % self.init_segment_repeat == 0 else False
             # get list of the file from the source
             file_list = self.source(getInit, getMPD)
-            if len(file_list.media) > 0:
-                # start new round.
-                self.start_new_round(file_list)
-            else:
-                # no file to upload. we can utilise this idle time for deletion!
-                self.deleter.delete_expired_files()
+            if len(file_list.media) == 0:
+                break
+            self.start_new_round(file_list)
+            consumed += 1
 
-        # self repeating
-        reactor.callLater(self.pollingInterval, self.round_runner)
+        if consumed:
+            # a summary of this channel only; dumping self.stat would format every channel's statistics
+            lag = max(len(pipeline.queue) + pipeline.on_fly_package_count for pipeline in self.pipelines)
+            logger.info("[round %d] %d new packages. The furthest destination is %d packages behind.",
+                        self.round, consumed, lag)
 
+    """
+    Async function polling the source in case a notification was missed.
+    """
+    def round_runner(self):
+        self.try_new_round()
 
+        # self repeating
+        self.timer = reactor.callLater(self.pollingInterval, self.round_runner)
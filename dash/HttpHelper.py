@@ -1,20 +1,135 @@
+from collections import namedtuple
+from functools import partial
+
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred
 from twisted.internet.protocol import Protocol
 from twisted.internet import defer
 from twisted.web.client import Agent
+from twisted.web.client import FileBodyProducer
+from twisted.web.client import HTTPConnectionPool
 from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
 from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer
+from twisted.web.iweb import UNKNOWN_LENGTH
+from zope.interface import implementer
 
 """ Make the ClientFactory silent """
 from twisted.web import client
 client._HTTP11ClientFactory.noisy = False
 
+"""
+Connection pool which keeps the connections alive between the requests and
+counts how many requests could reuse a cached connection (hit) and how many had
+to open a new one (miss)
+"""
+class CountingConnectionPool(HTTPConnectionPool):
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.stat = None
+
+    def getConnection(self, key, endpoint):
+        if self.stat is not None:
+            if self._connections.get(key):
+                self.stat.increase('connection_pool_hit_count')
+            else:
+                self.stat.increase('connection_pool_miss_count')
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+""" Single pool and agent shared by all the requests of puller and pusher """
+pool = CountingConnectionPool(reactor, persistent=True)
+pool.maxPersistentPerHost = 10
+pool.cachedConnectionTimeout = 60
+agent = Agent(reactor, pool=pool)
+
+"""
+Configure the shared connection pool. Should be called before the reactor starts.
+"""
+def configurePool(max_persistent_per_host=None, idle_timeout=None, stat=None):
+    if max_persistent_per_host is not None:
+        pool.maxPersistentPerHost = max_persistent_per_host
+    if idle_timeout is not None:
+        pool.cachedConnectionTimeout = idle_timeout
+    if stat is not None:
+        pool.stat = stat
+
+"""
+Whether the connection ended with the whole body: after Content-Length or the last chunk, or by
+closing a body which is delimited by the closing of the connection
+"""
+def body_complete(reason):
+    return reason.check(ResponseDone, PotentialDataLoss) is not None
+
+"""
+Collects the response body as a list of chunks and joins them once at the end,
+so receiving a body costs O(n) instead of O(n^2) for repeated string concatenation.
+Without d, it makes its own Deferred whose cancellation drops the connection.
+"""
+class BufferReceiver(Protocol):
+    def __init__(self, response, d=None):
+        self.response = response
+        self.d = d if d is not None else defer.Deferred(self.cancel)
+        self.chunks = []
+
+    def cancel(self, d):
+        # the body is not wanted anymore, e.g. the other hedged request won
+        if self.transport is not None:
+            self.transport.loseConnection()
+
+    def dataReceived(self, data):
+        self.chunks.append(data)
+
+    def connectionLost(self, reason):
+        if self.d.called:
+            # cancelled
+            self.chunks = []
+            return
+        if self.response.code >= 300:
+            self.d.errback(RuntimeError("Failed download: {} {}".format(self.response.code, self.response.phrase)))
+        elif not body_complete(reason):
+            # e.g. the connection dropped in the middle of the body
+            self.d.errback(reason)
+        else:
+            self.d.callback(''.join(self.chunks))
+        self.chunks = []
+
+"""
+Body producer writing an in-memory buffer to the connection as it is,
+without wrapping (and copying) it into a file-like object first.
+"""
+@implementer(IBodyProducer)
+class BufferBodyProducer(object):
+    def __init__(self, data):
+        self.data = data
+        self.length = len(data)
+
+    def startProducing(self, consumer):
+        consumer.write(self.data)
+        return defer.succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+"""
+Body producer of an upload. Files kept on the disk (anything with open()) are streamed
+from the file, in-memory buffers are written as they are.
+"""
+def bodyProducer(data):
+    if hasattr(data, 'open'):
+        return FileBodyProducer(data.open())
+    return BufferBodyProducer(data)
+
 """
 Asynchrnous HTTP Download
 """
 def getResource(path):
-    agent = Agent(reactor)
     d = agent.request(
         'GET',
         path,
@@ -25,37 +140,56 @@ def getResource(path):
         if response.code == 206:
             return defer.succeed('')
         else:
-            class SimpleReceiver(Protocol):
-                def __init__(s, d):
-                    s.buf = ''
-                    s.d = d
-
-                def dataReceived(s, data):
-                    s.buf += data
-
-                def connectionLost(s, reason):
-                    if response.code < 300:
-                        s.d.callback(s.buf)
-                    else:
-                        s.d.errback(RuntimeError("Failed download: {} {}".format(response.code, response.phrase)))
-
-            d = defer.Deferred()
-            response.deliverBody(SimpleReceiver(d))
-            return d
+            receiver = BufferReceiver(response)
+            response.deliverBody(receiver)
+            return receiver.d
     d.addCallback(handle_response)
     return d
+ConditionalResponse = namedtuple("ConditionalResponse", "modified data etag last_modified")
+
+"""
+Asynchrnous conditional HTTP download. Sends If-None-Match/If-Modified-Since with the
+given validators and fires with a ConditionalResponse. On 304 `modified` is False and
+`data` is None.
+"""
+def getConditionalResource(path, etag=None, last_modified=None):
+    headers = Headers({'User-Agent': ['playout proxy']})
+    if etag:
+        headers.addRawHeader('If-None-Match', etag)
+    if last_modified:
+        headers.addRawHeader('If-Modified-Since', last_modified)
+    d = agent.request('GET', path, headers, None)
+
+    def first_header(response, name):
+        values = response.headers.getRawHeaders(name)
+        return values[0] if values else None
+
+    def handle_response(response):
+        if response.code == 304:
+            return defer.succeed(ConditionalResponse(False, None, etag, last_modified))
+
+        d = defer.Deferred()
+        response.deliverBody(BufferReceiver(response, d))
+        d.addCallback(lambda data: ConditionalResponse(True, data, first_header(response, 'ETag'),
+                                                       first_header(response, 'Last-Modified')))
+        return d
+    d.addCallback(handle_response)
+    return d
+
 """
 Asynchrnous HTTP upload
 """
 def postResource(path, data):
-    agent = Agent(reactor)
-    from twisted.web.client import FileBodyProducer
-    from io import BytesIO
+    try:
+        producer = bodyProducer(data)
+    except IOError as e:
+        # e.g. the cached segment was purged meanwhile
+        return defer.fail(e)
     d = agent.request(
         'POST',
         path,
         Headers({'User-Agent': ['playout proxy']}),
-        FileBodyProducer(BytesIO(data)))
+        producer)
 
     def handle_response(response):
         if response.code < 300:
@@ -66,13 +200,177 @@ def postResource(path, data):
     d.addCallbacks(handle_response)
     return d
 
+"""
+Body producer of one relayed upload. Chunks are given by RelayReceiver as they
+are downloaded and sent with chunked transfer encoding. Pausing the upload pauses
+the download through the receiver so a slow destination doesn't make us buffer
+the whole segment.
+"""
+@implementer(IBodyProducer)
+class RelayBodyProducer(object):
+    def __init__(self, receiver):
+        self.length = UNKNOWN_LENGTH
+        self.receiver = receiver
+        self.consumer = None
+        self.pending = []
+        self.written = 0
+        self.paused = False
+        self.stopped = False
+        self.finished = None
+        # Failure or None once the download is over
+        self.result = None
+        self.completed = False
+
+    def startProducing(self, consumer):
+        self.consumer = consumer
+        self.finished = defer.Deferred()
+        for chunk in self.pending:
+            consumer.write(chunk)
+        self.pending = []
+        if self.completed:
+            self.fire()
+        return self.finished
+
+    def write(self, data):
+        if self.stopped:
+            return
+        self.written += len(data)
+        if self.consumer is None:
+            self.pending.append(data)
+        else:
+            self.consumer.write(data)
+
+    def finish(self, result):
+        self.completed = True
+        self.result = result
+        if self.finished is not None:
+            self.fire()
+
+    def fire(self):
+        if self.stopped:
+            return
+        if self.result is None:
+            self.finished.callback(None)
+        else:
+            self.finished.errback(self.result)
+
+    def pauseProducing(self):
+        if not self.paused:
+            self.paused = True
+            self.receiver.producer_paused()
+
+    def resumeProducing(self):
+        if self.paused:
+            self.paused = False
+            self.receiver.producer_resumed()
+
+    def stopProducing(self):
+        self.resumeProducing()
+        self.stopped = True
+        self.pending = []
+
+"""
+Receives the body of a relayed download and fans out every chunk to the uploads.
+The download is paused while any of the uploads is paused.
+"""
+class RelayReceiver(Protocol):
+    def __init__(self, response, d):
+        self.response = response
+        self.d = d
+        self.chunks = []
+        self.producers = []
+        self.paused_count = 0
+
+    def add_producer(self):
+        producer = RelayBodyProducer(self)
+        self.producers.append(producer)
+        return producer
+
+    def producer_paused(self):
+        self.paused_count += 1
+        if self.paused_count == 1 and self.transport is not None:
+            self.transport.pauseProducing()
+
+    def producer_resumed(self):
+        self.paused_count -= 1
+        if self.paused_count == 0 and self.transport is not None:
+            self.transport.resumeProducing()
+
+    def dataReceived(self, data):
+        self.chunks.append(data)
+        for producer in self.producers:
+            producer.write(data)
+
+    def connectionLost(self, reason):
+        if body_complete(reason):
+            for producer in self.producers:
+                producer.finish(None)
+            self.d.callback(''.join(self.chunks))
+        else:
+            for producer in self.producers:
+                producer.finish(reason)
+            self.d.errback(reason)
+        self.chunks = []
+
+"""
+Asynchrnous HTTP download relayed to the destinations while it is downloaded.
+Returns the download Deferred which fires with the whole body and a list of
+upload Deferreds, one for each destination, which fire with the number of
+uploaded bytes.
+"""
+def relayResource(path, destinations):
+    uploads = [defer.Deferred() for _ in destinations]
+
+    def fail_uploads(reason):
+        for upload in uploads:
+            upload.errback(reason)
+
+    def handle_upload_response(producer, response):
+        if response.code < 300:
+            return defer.succeed(producer.written)
+        else:
+            return defer.fail(RuntimeError("Failed upload: {} {}".format(response.code, response.phrase)))
+
+    def handle_upload_error(producer, reason):
+        producer.stopProducing()
+        return reason
+
+    def handle_response(response):
+        d = defer.Deferred()
+        if response.code == 206 or response.code >= 300:
+            fail_uploads(RuntimeError("Failed relay: {} {}".format(response.code, response.phrase)))
+            response.deliverBody(BufferReceiver(response, d))
+            return d
+
+        receiver = RelayReceiver(response, d)
+        for destination, upload in zip(destinations, uploads):
+            producer = receiver.add_producer()
+            ud = agent.request(
+                'POST',
+                destination,
+                Headers({'User-Agent': ['playout proxy']}),
+                producer)
+            ud.addCallbacks(partial(handle_upload_response, producer), partial(handle_upload_error, producer))
+            ud.chainDeferred(upload)
+        response.deliverBody(receiver)
+        return d
+
+    def handle_error(reason):
+        fail_uploads(reason)
+        return reason
+
+    d = agent.request(
+        'GET',
+        path,
+        Headers({'User-Agent': ['playout proxy']}),
+        None)
+    d.addCallbacks(handle_response, handle_error)
+    return d, uploads
+
 """
 Asynchrnous HTTP delete
 """
 def deleteResource(path):
-    agent = Agent(reactor)
-    from twisted.web.client import FileBodyProducer
-    from io import BytesIO
     d = agent.request(
         'DELETE',
         path,
@@ -80,7 +378,11 @@ def deleteResource(path):
         None)
 
     def handle_response(response):
-        return defer.succeed('')
+        # already gone is as good as deleted
+        if response.code < 300 or response.code == 404:
+            return defer.succeed('')
+        else:
+            return defer.fail(RuntimeError("Failed delete: {} {}".format(response.code, response.phrase)))
 
     d.addCallbacks(handle_response)
     return d
\ No newline at end of file
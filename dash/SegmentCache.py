@@ -0,0 +1,240 @@
+import json
+import os
+
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredLock
+from twisted.internet.threads import deferToThread
+
+import logging
+logger = logging.getLogger(__name__)
+
+"""
+Media segment kept on disk. Used in place of the in-memory buffer: its length is the
+size of the file and the uploads stream it from the file.
+"""
+class CachedSegment:
+    def __init__(self, path, length, package):
+        self.path = path
+        self.length = length
+        self.package = package
+
+    def __len__(self):
+        return self.length
+
+    def open(self):
+        return open(self.path, 'rb')
+
+"""
+On-disk cache of the downloaded media segment packages.
+Every package is written once under `directory` and recorded in a journal so that the
+packages which were not uploaded to every destination yet can be resumed after a restart.
+Packages are removed from the disk `retention` seconds after they were stored, unless the
+pusher has taken them and is still uploading them.
+The segments are written in a thread, one package at a time, so the packages are stored in order.
+"""
+class SegmentCache:
+    JOURNAL = 'packages.jsonl'
+
+    def __init__(self, directory, stat, retention=3600, interval=10):
+        self.directory = directory
+        self.stat = stat
+        self.retention = retention
+        self.interval = interval
+        # (stored time, sequence, [[filename, bandwidth]]) of the packages on the disk, oldest first
+        self.packages = deque()
+        self.sequence = 0
+        # packages every destination is done with
+        self.consumed_packages = set()
+        # packages taken by the pusher and not consumed yet
+        self.taken = set()
+        self.size = 0
+        self.timer = None
+        self.write_lock = DeferredLock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.journal = open(self.journal_path(), 'a')
+
+    def start(self):
+        self.timer = reactor.callLater(self.interval, self.run)
+
+    def stop(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+    def run(self):
+        self.purge()
+        self.timer = reactor.callLater(self.interval, self.run)
+
+    def journal_path(self):
+        return os.path.join(self.directory, self.JOURNAL)
+
+    """
+    Path of a segment in the cache. Segment names are relative to the MPD and may have
+    directories but must not go out of the cache directory.
+    """
+    def segment_path(self, filename):
+        name = os.path.normpath(filename.split('?')[0]).lstrip(os.sep)
+        if name.startswith(os.pardir):
+            raise ValueError("Segment name out of the cache directory: {}".format(filename))
+        return os.path.join(self.directory, name)
+
+    def write_journal(self, record):
+        self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+
+    """
+    Write a package to the disk. Returns a Deferred firing with the files with CachedSegments
+    in place of the data.
+    """
+    def store(self, files, bandwidths=None):
+        bandwidths = bandwidths or {}
+        self.sequence += 1
+        sequence = self.sequence
+        paths = [self.segment_path(filename) for filename, _ in files]
+
+        def on_written(_):
+            cached_files = []
+            for (filename, data), path in zip(files, paths):
+                cached_files.append([filename, CachedSegment(path, len(data), sequence)])
+                self.size += len(data)
+            entries = [[filename, bandwidths.get(filename)] for filename, _ in files]
+            stored_at = reactor.seconds()
+            self.packages.append((stored_at, sequence, entries))
+            self.write_journal({'package': sequence, 'time': stored_at, 'files': entries})
+            self.update_stat()
+            return cached_files
+
+        d = self.write_lock.run(deferToThread, self.write_files, files, paths)
+        d.addCallback(on_written)
+        return d
+
+    # runs in a thread
+    def write_files(self, files, paths):
+        for (filename, data), path in zip(files, paths):
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # written aside and renamed so a crash never leaves a partial segment behind
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.rename(path + '.tmp', path)
+
+    def package_sequences(self, files):
+        return set(data.package for _, data in files if isinstance(data, CachedSegment))
+
+    """
+    Record that a package was handed over to the pusher, so it isn't purged while it is uploaded
+    """
+    def take(self, files):
+        self.taken.update(self.package_sequences(files))
+
+    """
+    Record that every destination is done with a package, so it won't be resumed
+    """
+    def consumed(self, files):
+        for sequence in self.package_sequences(files):
+            self.taken.discard(sequence)
+            self.consumed_packages.add(sequence)
+            self.write_journal({'consumed': sequence})
+
+    """
+    Load the journal left by the previous run. Returns the packages which were not consumed
+    and are still on the disk, oldest first, as (files, bandwidths).
+    """
+    def resume(self):
+        self.journal.close()
+        records = []
+        with open(self.journal_path()) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line may be cut by a crash
+                    logger.warning("Skip broken journal record: %r", line)
+                    continue
+                if 'consumed' in record:
+                    self.consumed_packages.add(record['consumed'])
+                else:
+                    # json gives unicode but the segment names are used in byte string urls
+                    record['files'] = [[str(filename), bandwidth] for filename, bandwidth in record['files']]
+                    records.append(record)
+
+        expire_time = reactor.seconds() - self.retention
+        resumed = []
+        for record in records:
+            self.sequence = max(self.sequence, record['package'])
+            entries = []
+            for filename, bandwidth in record['files']:
+                path = self.segment_path(filename)
+                if os.path.exists(path):
+                    entries.append([filename, bandwidth])
+                    self.size += os.path.getsize(path)
+            if not entries:
+                continue
+            self.packages.append((record['time'], record['package'], entries))
+            if record['package'] not in self.consumed_packages and record['time'] > expire_time:
+                resumed.append(record)
+
+        on_disk = set(sequence for _, sequence, _ in self.packages)
+        self.consumed_packages &= on_disk
+        self.rewrite_journal()
+        self.purge()
+
+        packages = []
+        for record in resumed:
+            files = []
+            bandwidths = {}
+            for filename, bandwidth in record['files']:
+                path = self.segment_path(filename)
+                if os.path.exists(path):
+                    files.append([filename, CachedSegment(path, os.path.getsize(path), record['package'])])
+                    bandwidths[filename] = bandwidth
+            if files:
+                packages.append((files, bandwidths))
+        logger.info("Resume %d packages from %s", len(packages), self.directory)
+        return packages
+
+    """
+    Remove the packages stored more than `retention` seconds ago. The oldest package the pusher
+    is still uploading and the ones after it are kept until it is consumed.
+    """
+    def purge(self):
+        expire_time = reactor.seconds() - self.retention
+        purged = 0
+        while self.packages and self.packages[0][0] <= expire_time and self.packages[0][1] not in self.taken:
+            _, sequence, entries = self.packages.popleft()
+            self.consumed_packages.discard(sequence)
+            for filename, _ in entries:
+                path = self.segment_path(filename)
+                try:
+                    self.size -= os.path.getsize(path)
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning("Failed to remove %s: %s", path, e)
+            purged += 1
+        if purged:
+            logger.debug("Purged %d packages from the cache", purged)
+            self.rewrite_journal()
+        self.update_stat()
+
+    """
+    Replace the journal with the packages still on the disk
+    """
+    def rewrite_journal(self):
+        if not self.journal.closed:
+            self.journal.close()
+        path = self.journal_path()
+        with open(path + '.tmp', 'w') as f:
+            for stored_at, sequence, entries in self.packages:
+                f.write(json.dumps({'package': sequence, 'time': stored_at, 'files': entries}) + '\n')
+                if sequence in self.consumed_packages:
+                    f.write(json.dumps({'consumed': sequence}) + '\n')
+        os.rename(path + '.tmp', path)
+        self.journal = open(path, 'a')
+
+    def update_stat(self):
+        self.stat.set('segment_cache_bytes', self.size)
+        self.stat.set('segment_cache_packages', len(self.packages))
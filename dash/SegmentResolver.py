@@ -0,0 +1,356 @@
+import re
+from array import array
+from bisect import bisect_right
+from urlparse import urljoin, urlsplit
+
+import logging
+logger = logging.getLogger(__name__)
+
+# how the segments of a representation are addressed
+SEGMENT_TEMPLATE = 'template'
+SEGMENT_LIST = 'list'
+SEGMENT_BASE = 'base'
+
+# $$, $RepresentationID$ and $Number$, $Bandwidth$, $Time$, $SubNumber$ with an optional %0[width]d
+TEMPLATE_IDENTIFIER = re.compile(r'\$(?:(RepresentationID)|(Number|Bandwidth|Time|SubNumber)(?:%0?(\d*)d)?)?\$')
+TEMPLATE_CACHE_SIZE = 1024
+
+"""
+Segment URL template (SegmentTemplate@media or @initialization) compiled once into literal
+parts and (identifier, width) fields, and rendered with a single str.format call.
+Unknown identifiers are kept as they are.
+"""
+class UrlTemplate:
+    def __init__(self, parts):
+        # adjacent literals are merged
+        self.parts = []
+        for part in parts:
+            if self.parts and not isinstance(part, tuple) and not isinstance(self.parts[-1], tuple):
+                self.parts[-1] += part
+            elif part:
+                self.parts.append(part)
+        self.format_string = ''.join(self.format_part(part) for part in self.parts)
+
+    def format_part(self, part):
+        if isinstance(part, tuple):
+            name, width = part
+            return '{%s:0%dd}' % (name, width) if width else '{%s}' % name
+        return part.replace('{', '{{').replace('}', '}}')
+
+    """
+    Template with the given identifiers substituted, e.g. RepresentationID and Bandwidth once per representation
+    """
+    def bind(self, **values):
+        parts = []
+        for part in self.parts:
+            if isinstance(part, tuple) and part[0] in values:
+                part = self.format_part(part).format(**values)
+            parts.append(part)
+        return UrlTemplate(parts)
+
+    def render(self, **values):
+        try:
+            return self.format_string.format(**values)
+        except KeyError as e:
+            raise ValueError("No value for ${}$ in {!r}".format(e.args[0], self.format_string))
+
+_templates = {}
+
+"""
+Compile a template, cached by the template string
+"""
+def compile_template(template):
+    compiled = _templates.get(template)
+    if compiled is not None:
+        return compiled
+    parts = []
+    position = 0
+    for match in TEMPLATE_IDENTIFIER.finditer(template):
+        parts.append(template[position:match.start()])
+        position = match.end()
+        name = match.group(1) or match.group(2)
+        # $$ is a $
+        parts.append((name, int(match.group(3) or 0)) if name is not None else '$')
+    parts.append(template[position:])
+    if len(_templates) >= TEMPLATE_CACHE_SIZE:
+        _templates.clear()
+    compiled = _templates[template] = UrlTemplate(parts)
+    return compiled
+
+def first(nodes):
+    return nodes[0] if nodes else None
+
+"""
+Value of `attr` on the first of `elements` (most specific first) which has it set
+"""
+def inherit(elements, attr):
+    for element in elements:
+        value = getattr(element, attr)
+        if value is not None:
+            return value
+    return None
+
+"""
+`url` with the first BaseURL of `node` applied, if it has one
+"""
+def join_base_url(url, node):
+    base_url = first(node.base_urls)
+    if base_url is None or not base_url.base_url_value:
+        return url
+    return urljoin(url, base_url.base_url_value.strip())
+
+"""
+The <S> runs of a SegmentTimeline with their start times and numbers resolved, in packed arrays
+built once per MPD version, so a refresh bisects to the run holding its cursor and only walks
+the runs after it. An open run (r="-1") repeats until the next <S>; the last one repeats until
+the `end` of the lookup (the live edge or the end of the period, in the timescale).
+"""
+class TimelineIndex:
+    def __init__(self, timeline, start_number):
+        self.times = array('l')
+        self.numbers = array('l')
+        self.durations = array('l')
+        # -1 for an open last run, which is resolved against `end`
+        self.repeats = array('l')
+        no_time = timeline.NO_TIME
+        ts, ds, rs = timeline.ts, timeline.ds, timeline.rs
+        count = len(ds)
+        number = start_number
+        time = 0
+        for index in xrange(count):
+            t, d, repeat = ts[index], ds[index], rs[index]
+            if t != no_time:
+                time = t
+            if repeat < 0 and index + 1 < count:
+                next_time = ts[index + 1]
+                repeat = (next_time - time) // d - 1 if next_time != no_time else 0
+                if repeat < 0:
+                    # no complete segment yet
+                    continue
+            self.times.append(time)
+            self.numbers.append(number)
+            self.durations.append(d)
+            self.repeats.append(-1 if repeat < 0 else repeat)
+            number += repeat + 1
+            time += d * (repeat + 1)
+
+    # (start time, start number, duration, repeat) of a run, repeat is negative if it has no segment yet
+    def run(self, index, end):
+        time, d, repeat = self.times[index], self.durations[index], self.repeats[index]
+        if repeat < 0:
+            # without an end, only the first segment of the run is known
+            repeat = (end - time) // d - 1 if end is not None else 0
+        return time, self.numbers[index], d, repeat
+
+    """
+    Segments which start after `after` (all of them if None) as (time, number, duration).
+    """
+    def segments(self, after=None, end=None):
+        first_run = 0
+        if after is not None:
+            # the last run starting at or before `after` may still hold newer segments
+            first_run = max(0, bisect_right(self.times, after) - 1)
+        segments = []
+        for index in xrange(first_run, len(self.times)):
+            time, number, d, repeat = self.run(index, end)
+            if repeat < 0:
+                continue
+            if after is None or after < time:
+                first = 0
+            elif time + d * repeat > after:
+                first = (after - time) // d + 1
+            else:
+                continue
+            for k in xrange(first, repeat + 1):
+                segments.append((time + k * d, number + k, d))
+        return segments
+
+    """
+    The newest segment as (time, number, duration) or None if there is none.
+    """
+    def last_segment(self, end=None):
+        index = len(self.times) - 1
+        while index >= 0:
+            time, number, d, repeat = self.run(index, end)
+            if repeat >= 0:
+                return time + d * repeat, number + repeat, d
+            # only the open last run can have no segment, the one before it is complete
+            index -= 1
+        return None
+
+"""
+Start and end of each period in seconds since availabilityStartTime. A period without start
+begins where the previous one ends, and a period without duration ends where the next one
+begins; the end of the last one is None while it is open.
+"""
+def period_times(periods):
+    times = []
+    start = 0
+    for period in periods:
+        if period.start is not None:
+            start = float(period.start)
+        end = start + float(period.duration) if period.duration is not None else None
+        times.append([start, end])
+        if end is not None:
+            start = end
+    for index in xrange(len(times) - 1):
+        if times[index][1] is None:
+            times[index][1] = times[index + 1][0]
+    return times
+
+"""
+How the segments of a representation are found, resolved once per MPD version: the segment
+information inherited along Period, AdaptationSet and Representation, the BaseURL chain and the
+compiled media and initialization templates with $RepresentationID$ and $Bandwidth$ substituted.
+Segment names are the paths relative to the directory of the MPD, which is where they are
+pushed to; a segment out of that directory is named after the path of its URL.
+"""
+class RepresentationAddressing:
+    def __init__(self, mpd_url, base_url, period, period_key, adaptation_set, representation):
+        self.key = (period_key, representation.id)
+        self.representation_id = representation.id
+        self.bandwidth = representation.bandwidth
+        self.content_type = adaptation_set.content_type
+        self.mpd_directory = urljoin(mpd_url, '.')
+        self.base_url = base_url
+        # plain relative paths under the base URL and the MPD directory only need a concatenation
+        self.base_directory = urljoin(base_url, '.')
+        self.name_prefix = None
+        if self.base_directory.endswith('/') and self.base_directory.startswith(self.mpd_directory):
+            self.name_prefix = self.base_directory[len(self.mpd_directory):]
+
+        levels = (representation, adaptation_set, period)
+        templates = [level.segment_templates[0] for level in levels if level.segment_templates]
+        lists = [level.segment_lists[0] for level in levels if level.segment_lists]
+        bases = [level.segment_bases[0] for level in levels if level.segment_bases]
+        if templates:
+            self.kind, elements = SEGMENT_TEMPLATE, templates
+        elif lists:
+            self.kind, elements = SEGMENT_LIST, lists
+        else:
+            self.kind, elements = SEGMENT_BASE, bases
+
+        self.timescale = inherit(elements, 'timescale') or 1
+        self.presentation_time_offset = inherit(elements, 'presentation_time_offset') or 0
+        self.duration = None
+        self.start_number = 1
+        self.timeline = None
+        self.timeline_index = None
+        self.segment_urls = []
+        self.media = None
+        if self.kind != SEGMENT_BASE:
+            self.duration = inherit(elements, 'duration')
+            start_number = inherit(elements, 'start_number')
+            self.start_number = start_number if start_number is not None else 1
+            self.timeline = first(inherit(elements, 'segment_timelines'))
+            if self.timeline is not None:
+                self.timeline_index = TimelineIndex(self.timeline, self.start_number)
+        if self.kind == SEGMENT_LIST:
+            self.segment_urls = inherit(elements, 'segment_urls') or []
+        if self.kind == SEGMENT_TEMPLATE:
+            self.media = self.substitute(inherit(elements, 'media'))
+
+        # the initialization attribute of a template, else an Initialization element
+        initialization = inherit(elements, 'initialization') if self.kind == SEGMENT_TEMPLATE else None
+        if initialization is None:
+            url = first(inherit(elements, 'initializations'))
+            initialization = url.source_url if url is not None else None
+        self.initialization = self.substitute(initialization)
+
+    # compiled template with the identifiers of the representation substituted
+    def substitute(self, template):
+        if template is None:
+            return None
+        return compile_template(template).bind(RepresentationID=self.representation_id, Bandwidth=self.bandwidth)
+
+    """
+    (name, url) of a path relative to the base URL. An empty path is the base URL itself.
+    """
+    def locate(self, path):
+        if self.name_prefix is not None and path and ':' not in path and not path.startswith(('/', '.')):
+            return self.name_prefix + path, self.base_directory + path
+        url = urljoin(self.base_url, path)
+        if url.startswith(self.mpd_directory):
+            return url[len(self.mpd_directory):], url
+        return urlsplit(url).path.lstrip('/'), url
+
+    def media_name(self, number=None, time=None):
+        if time is None:
+            return self.media.render(Number=number)
+        return self.media.render(Number=number, Time=time)
+
+    # (name, url) of the initialization segment or None if there is no separate one
+    def initialization_segment(self):
+        if self.initialization is None:
+            return None
+        return self.locate(self.initialization.render())
+
+    # duration of the segments in seconds, the last one of a timeline, or None if unknown
+    def segment_duration(self):
+        if self.timeline is not None and len(self.timeline):
+            return float(self.timeline.ds[-1]) / self.timescale
+        if self.duration:
+            return float(self.duration) / self.timescale
+        return None
+
+"""
+A period which has segments in the time shift buffer, with its start and end in seconds since
+availabilityStartTime (end is None while open), how long it has been running up to the live edge
+or its end (None if unknown)
+and the addressing of its representations.
+"""
+class ActivePeriod:
+    def __init__(self, period, start, end, elapsed, representations):
+        self.period = period
+        self.start = start
+        self.end = end
+        self.elapsed = elapsed
+        self.representations = representations
+
+"""
+Addressing of every representation of a period
+"""
+def resolve_period(mpd_url, mpd, period, period_key):
+    period_base = join_base_url(join_base_url(mpd_url, mpd), period)
+    representations = []
+    for adaptation_set in period.adaptation_sets or []:
+        adaptation_set_base = join_base_url(period_base, adaptation_set)
+        for representation in adaptation_set.representations or []:
+            representations.append(RepresentationAddressing(
+                mpd_url, join_base_url(adaptation_set_base, representation), period, period_key,
+                adaptation_set, representation))
+    return representations
+
+"""
+The periods of the MPD which still have segments in the time shift buffer, oldest first.
+`live_edge` is the current time in seconds since availabilityStartTime; without it only the
+last period is taken. `resolved` caches the addressing of the periods of the MPD version
+by period key, so the MPD is resolved only once however often its live edge is looked at.
+"""
+def resolve_active_periods(mpd_url, mpd, live_edge, time_shift_buffer_depth, resolved=None):
+    resolved = resolved if resolved is not None else {}
+    periods = mpd.periods or []
+    active = []
+    for index, (period, (start, end)) in enumerate(zip(periods, period_times(periods))):
+        if live_edge is None:
+            if index < len(periods) - 1:
+                continue
+        elif start > live_edge or (end is not None and end < live_edge - time_shift_buffer_depth):
+            continue
+        if live_edge is not None:
+            # a period with a duration may still be running, e.g. an ad break
+            elapsed = live_edge - start
+            if period.duration is not None:
+                elapsed = min(float(period.duration), elapsed)
+        elif period.duration is not None:
+            elapsed = float(period.duration)
+        else:
+            elapsed = None
+        period_key = period.id if period.id is not None else start
+        if period_key not in resolved:
+            resolved[period_key] = resolve_period(mpd_url, mpd, period, period_key)
+        active.append(ActivePeriod(period, start, end, elapsed, resolved[period_key]))
+    if not active and periods:
+        # e.g. the clock of the origin is off
+        return resolve_active_periods(mpd_url, mpd, None, time_shift_buffer_depth, resolved)
+    return active
@@ -0,0 +1,116 @@
+from collections import deque
+
+from SegmentCache import CachedSegment
+
+import logging
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop-oldest'
+DROP_LOWEST_BITRATE = 'drop-lowest-bitrate'
+EVICTION_POLICIES = [DROP_OLDEST, DROP_LOWEST_BITRATE]
+
+"""
+Bytes a segment takes in memory. The segments kept on the disk take none.
+"""
+def memory_size(data):
+    return 0 if isinstance(data, CachedSegment) else len(data)
+
+"""
+Queue of downloaded media segment packages bounded by a budget of bytes in memory.
+The packages taken from the store but still queued by the destination pipelines are held
+against the same budget (see hold and release).
+When the budget is exceeded, either the oldest packages or the files of the lowest
+bitrate are evicted until it fits again. The newest package is always kept whole. If the
+held packages alone exceed the budget, on_over_budget is called to have them dropped.
+"""
+class SegmentStore:
+    def __init__(self, budget, stat, policy=DROP_OLDEST):
+        if policy not in EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy: {}".format(policy))
+        self.budget = budget
+        self.stat = stat
+        self.policy = policy
+        # [files, bandwidths, available] where files are [filename, data], bandwidths maps filename
+        # to bitrate and available maps filename to the time it became available on the origin
+        self.packages = deque()
+        self.size = 0
+        # bytes of the packages taken from the store which are still held
+        self.held = 0
+        self.on_over_budget = None
+
+    def __len__(self):
+        return len(self.packages)
+
+    def append(self, files, bandwidths=None, available=None):
+        # e.g. every download of the group failed
+        if not files:
+            return
+        self.packages.append([files, bandwidths or {}, available or {}])
+        self.size += sum(memory_size(data) for _, data in files)
+        self.evict()
+        self.update_stat()
+
+    """
+    Take the oldest package as (files, available)
+    """
+    def pop(self):
+        files, _, available = self.packages.popleft()
+        self.size -= sum(memory_size(data) for _, data in files)
+        self.update_stat()
+        return files, available
+
+    def hold(self, size):
+        self.held += size
+        self.evict()
+        self.update_stat()
+
+    def release(self, size):
+        self.held -= size
+        self.update_stat()
+
+    def over_budget(self):
+        return self.size + self.held > self.budget
+
+    def evict(self):
+        while self.over_budget() and len(self.packages) > 1:
+            if self.policy == DROP_OLDEST:
+                files, _ = self.pop()
+                self.on_evicted(files)
+            else:
+                self.evict_lowest_bitrate()
+        if self.over_budget() and self.held and self.on_over_budget is not None:
+            self.on_over_budget()
+
+    """
+    Evict the file of the lowest bitrate, the oldest one if several have the same bitrate.
+    """
+    def evict_lowest_bitrate(self):
+        lowest = None
+        for package_index in xrange(len(self.packages) - 1):
+            files, bandwidths, _ = self.packages[package_index]
+            for file_index, (filename, _) in enumerate(files):
+                bandwidth = bandwidths.get(filename, 0)
+                if lowest is None or bandwidth < lowest[0]:
+                    lowest = (bandwidth, package_index, file_index)
+        if lowest is None:
+            # only empty packages before the newest one
+            self.packages.popleft()
+            return
+
+        _, package_index, file_index = lowest
+        files = self.packages[package_index][0]
+        evicted = files.pop(file_index)
+        self.size -= memory_size(evicted[1])
+        if not files:
+            del self.packages[package_index]
+        self.on_evicted([evicted])
+
+    def on_evicted(self, files):
+        logger.warning("Segment store is over budget. Evict %d files.", len(files))
+        self.stat.append('segment_store_evicted_files', len(files))
+        self.stat.append('segment_store_evicted_bytes', sum(len(data) for _, data in files))
+
+    def update_stat(self):
+        self.stat.set('segment_store_bytes', self.size + self.held)
+        self.stat.set('segment_store_held_bytes', self.held)
+        self.stat.set('segment_store_packages', len(self.packages))
@@ -0,0 +1,242 @@
+import json
+import os
+import signal
+import sys
+
+from twisted.internet import reactor
+from twisted.internet.error import ReactorNotRunning
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols.basic import LineReceiver
+
+from dash.ChannelManager import ChannelManager
+from common.HashRing import HashRing
+
+import logging
+logger = logging.getLogger(__name__)
+
+# file descriptor of the worker on which it reports its statistics
+STAT_FD = 3
+# statistics kept by the supervisor itself, not summed up from the workers
+SUPERVISOR_STATS = ('worker_count', 'worker_restart_count', 'channel_count')
+
+"""
+Supervisor side of a worker process. Sends the channels to run to the worker's stdin
+and reads the statistics the worker reports on STAT_FD, one JSON object per line.
+A line with a "traces" key holds the traces the worker finished since its last report.
+"""
+class WorkerProcess(ProcessProtocol):
+    def __init__(self, supervisor, worker_id):
+        self.supervisor = supervisor
+        self.worker_id = worker_id
+        self.buffer = ''
+        self.stat = None
+        self.running = False
+
+    def connectionMade(self):
+        self.running = True
+        self.supervisor.on_worker_started(self)
+
+    def send(self, config):
+        if self.running:
+            self.transport.write(json.dumps(config) + '\n')
+
+    """
+    Let the worker stop by closing its stdin (see WorkerControl.connectionLost)
+    """
+    def stop(self):
+        if self.running:
+            self.transport.closeStdin()
+
+    def childDataReceived(self, fd, data):
+        if fd != STAT_FD:
+            return
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logger.warning("[worker %d] Broken statistics: %r", self.worker_id, line)
+                continue
+            if 'traces' in record:
+                self.supervisor.on_traces(record['traces'])
+            else:
+                self.stat = record
+
+    def processEnded(self, reason):
+        self.running = False
+        self.supervisor.on_worker_ended(self, reason)
+
+"""
+Runs the channels of the config file on `workers` worker processes, each with its own reactor.
+Channels are consistently hashed onto the workers so changing the number of workers only
+moves the channels of the added or removed workers. The number of workers can be changed
+at runtime with a top level "workers" key in the config file.
+Crashed workers are restarted after `restart_delay` seconds and get their channels back.
+The statistics reported by the workers are summed up into `stat` and their traces are added
+to `tracer` if it is given.
+`command` is the command line of a worker; it is given the channels on stdin (see WorkerControl).
+"""
+class Supervisor(ChannelManager):
+    def __init__(self, config_path, defaults, stat, command, workers, reload_interval=5, restart_delay=1,
+                 tracer=None):
+        ChannelManager.__init__(self, config_path, defaults, stat, reload_interval, tracer)
+        self.command = command
+        self.worker_count = workers
+        self.restart_delay = restart_delay
+        self.ring = HashRing()
+        self.workers = {}
+        self.config = {}
+        self.stopping = False
+
+    def start(self):
+        self.resize(self.worker_count)
+        ChannelManager.start(self)
+
+    def stop(self):
+        self.stopping = True
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        for worker in self.workers.values():
+            worker.stop()
+
+    def run(self):
+        self.aggregate()
+        logger.info(self.stat)
+        ChannelManager.run(self)
+
+    def configure(self, config):
+        # validate before handing it to the workers
+        self.load_channels(config)
+        self.config = config
+        self.resize(config.get('workers', self.worker_count))
+        self.rebalance()
+
+    """
+    Start or stop workers to have `count` of them
+    """
+    def resize(self, count):
+        for worker_id in xrange(count):
+            if worker_id not in self.workers:
+                self.ring.add(worker_id)
+                self.spawn(worker_id)
+        for worker_id in sorted(self.workers):
+            if worker_id >= count:
+                self.ring.remove(worker_id)
+                worker = self.workers.pop(worker_id)
+                if worker.running:
+                    logger.info("Stop worker %d", worker_id)
+                    worker.stop()
+        self.stat.set('worker_count', len(self.workers))
+
+    def spawn(self, worker_id):
+        logger.info("Start worker %d", worker_id)
+        worker = WorkerProcess(self, worker_id)
+        self.workers[worker_id] = worker
+        reactor.spawnProcess(worker, self.command[0], self.command, env=os.environ,
+                             childFDs={0: 'w', 1: 1, 2: 2, STAT_FD: 'r'})
+
+    """
+    Channels of the config which are hashed onto the worker
+    """
+    def assignment(self, worker_id):
+        channels = self.config.get('channels', {})
+        return {'channels': dict((name, overrides) for name, overrides in channels.items()
+                                 if self.ring.get(name) == worker_id)}
+
+    def rebalance(self):
+        for worker_id, worker in self.workers.items():
+            worker.send(self.assignment(worker_id))
+        self.stat.set('channel_count', len(self.config.get('channels', {})))
+
+    def on_worker_started(self, worker):
+        worker.send(self.assignment(worker.worker_id))
+
+    def on_worker_ended(self, worker, reason):
+        if self.stopping or self.workers.get(worker.worker_id) is not worker:
+            return
+        logger.error("Worker %d ended: %s. Restart after %d seconds.",
+                     worker.worker_id, reason.getErrorMessage(), self.restart_delay)
+        self.stat.increase('worker_restart_count')
+        reactor.callLater(self.restart_delay, self.restart, worker)
+
+    def restart(self, worker):
+        # it may have been removed in the meantime
+        if not self.stopping and self.workers.get(worker.worker_id) is worker:
+            self.spawn(worker.worker_id)
+
+    def on_traces(self, traces):
+        if self.tracer is None:
+            return
+        for trace in traces:
+            self.tracer.add(trace)
+
+    """
+    Sum the statistics of the workers into `stat`
+    """
+    def aggregate(self):
+        for key in self.stat.data.keys():
+            if key not in SUPERVISOR_STATS:
+                del self.stat.data[key]
+        for worker in self.workers.values():
+            if worker.stat is None:
+                continue
+            snapshot = dict(worker.stat)
+            snapshot['data'] = dict((key, value) for key, value in worker.stat['data'].items()
+                                    if key not in SUPERVISOR_STATS)
+            self.stat.merge(snapshot)
+
+"""
+Worker side: reads the channels to run from stdin and runs them with its ChannelManager.
+If tracer is given, the traces it finishes are forwarded to the supervisor with the reports.
+"""
+class WorkerControl(LineReceiver):
+    delimiter = '\n'
+
+    def __init__(self, manager, tracer=None):
+        self.manager = manager
+        self.traces = None
+        if tracer is not None:
+            self.traces = []
+            tracer.add_listener(self.traces.append)
+
+    def lineReceived(self, line):
+        try:
+            self.manager.configure(json.loads(line))
+        except ValueError as e:
+            logger.error("Broken channel assignment: %s", e)
+
+    def report(self, stat):
+        self.transport.write(json.dumps(stat.snapshot()) + '\n')
+        if self.traces:
+            self.transport.write(json.dumps({'traces': self.traces}) + '\n')
+            del self.traces[:]
+
+    def connectionLost(self, reason):
+        # the supervisor stopped the worker or is gone
+        stop_reactor()
+
+"""
+Stop the reactor unless it is already stopping. The worker may be asked to stop more than once,
+e.g. by its stdin being closed and by a SIGTERM.
+"""
+def stop_reactor():
+    try:
+        reactor.stop()
+    except ReactorNotRunning:
+        pass
+
+"""
+Signal handlers of a worker: SIGTERM stops it once, and SIGINT, which Ctrl-C sends to the
+whole process group, is left to the supervisor. To be called once the reactor is running.
+"""
+def handle_worker_signals():
+    signal.signal(signal.SIGTERM, lambda signum, frame: reactor.callFromThread(stop_reactor))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+"""
+Command line to start a worker: this program with the same arguments and --worker
+"""
+def worker_command():
+    return [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:] + ['--worker']
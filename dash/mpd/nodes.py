@@ -1,6 +1,10 @@
+from array import array
+
 from utils import *
 
 class XMLNode(object):
+    __slots__ = ()
+
     def parse(self, xmlnode):
         raise NotImplementedError('Should have implemented this')
 
@@ -9,6 +13,8 @@ class XMLNode(object):
 
 
 class Subset(XMLNode):
+    __slots__ = ('id', 'contains')
+
     def __init__(self):
         self.id = None                                        # xs:string
         self.contains = []                                    # UIntVectorType (required)
@@ -23,6 +29,8 @@ class Subset(XMLNode):
 
 
 class URL(XMLNode):
+    __slots__ = ('source_url', 'range')
+
     def __init__(self):
         self.source_url = None                                # xs:anyURI
         self.range = None                                     # xs:string
@@ -37,6 +45,9 @@ class URL(XMLNode):
 
 
 class BaseURL(XMLNode):
+    __slots__ = ('base_url_value', 'service_location', 'byte_range', 'availability_time_offset',
+                 'availability_time_complete')
+
     def __init__(self):
         self.base_url_value = None                            # xs:anyURI
 
@@ -63,6 +74,8 @@ class BaseURL(XMLNode):
 
 
 class ProgramInformation(XMLNode):
+    __slots__ = ('lang', 'more_information_url', 'titles', 'sources', 'copyrights')
+
     def __init__(self):
         self.lang = None                                      # xs:language
         self.more_information_url = None                      # xs:anyURI
@@ -89,6 +102,8 @@ class ProgramInformation(XMLNode):
 
 
 class Metrics(XMLNode):
+    __slots__ = ('metrics', 'reportings', 'ranges')
+
     def __init__(self):
         self.metrics = ''                                     # xs:string (required)
 
@@ -109,13 +124,15 @@ class Metrics(XMLNode):
 
 
 class Range(XMLNode):
+    __slots__ = ('starttime', 'duration')
+
     def __init__(self):
         self.starttime = None                                 # xs:duration
         self.duration = None                                  # xs:duration
 
     def parse(self, xmlnode):
-        self.starttime = parse_attr_value(xmlnode, 'starttime', str)
-        self.duration = parse_attr_value(xmlnode, 'duration', str)
+        self.starttime = parse_attr_value(xmlnode, 'starttime', parse_duration)
+        self.duration = parse_attr_value(xmlnode, 'duration', parse_duration)
 
     def write(self, xmlnode):
         write_attr_value(xmlnode, 'starttime', self.starttime)
@@ -123,6 +140,8 @@ class Range(XMLNode):
 
 
 class SegmentURL(XMLNode):
+    __slots__ = ('media', 'media_range', 'index', 'index_range')
+
     def __init__(self):
         self.media = None                                     # xs:anyURI
         self.media_range = None                               # xs:string
@@ -143,6 +162,8 @@ class SegmentURL(XMLNode):
 
 
 class S(XMLNode):
+    __slots__ = ('t', 'd', 'r')
+
     def __init__(self):
         self.t = None                                         # xs:unsignedLong
         self.d = 0                                            # xs:unsignedLong (required)
@@ -159,18 +180,61 @@ class S(XMLNode):
         write_attr_value(xmlnode, 'r', self.r)
 
 
+"""
+The <S> runs are kept in three packed arrays instead of an S object per run.
+A missing t is stored as NO_TIME and a missing r as 0.
+"""
 class SegmentTimeline(XMLNode):
+    __slots__ = ('ts', 'ds', 'rs')
+
+    NO_TIME = -1
+
     def __init__(self):
-        self.Ss = None                                        # xs:complexType+
+        self.ts = array('l')                                  # xs:unsignedLong of each S
+        self.ds = array('l')                                  # xs:unsignedLong of each S (required)
+        self.rs = array('l')                                  # xml:integer of each S
+
+    def __len__(self):
+        return len(self.ds)
+
+    """
+    (t, d, r) of each <S>, t is None if it is not given
+    """
+    def runs(self):
+        no_time = self.NO_TIME
+        for t, d, r in zip(self.ts, self.ds, self.rs):
+            yield (None if t == no_time else t), d, r
+
+    def append(self, t, d, r=0):
+        self.ts.append(self.NO_TIME if t is None else t)
+        self.ds.append(d)
+        self.rs.append(r or 0)
+
+    @property
+    def Ss(self):
+        nodes = []
+        for t, d, r in self.runs():
+            node = S()
+            node.t = t
+            node.d = d
+            node.r = r or None
+            nodes.append(node)
+        return nodes or None
 
     def parse(self, xmlnode):
-        self.Ss = parse_child_nodes(xmlnode, 'S', S)
+        for elem in find_child_nodes(xmlnode, 'S'):
+            self.append(parse_attr_value(elem, 't', int), parse_attr_value(elem, 'd', int) or 0,
+                        parse_attr_value(elem, 'r', int))
 
     def write(self, xmlnode):
         write_child_node(xmlnode, 'S', self.Ss)
 
 
 class SegmentBase(XMLNode):
+    __slots__ = ('timescale', 'index_range', 'index_range_exact', 'presentation_time_offset',
+                 'availability_time_offset', 'availability_time_complete', 'initializations',
+                 'representation_indexes')
+
     def __init__(self):
         self.timescale = None                                 # xs:unsignedInt
         self.index_range = None                               # xs:string
@@ -206,6 +270,8 @@ class SegmentBase(XMLNode):
 
 
 class MultipleSegmentBase(SegmentBase):
+    __slots__ = ('duration', 'start_number', 'segment_timelines', 'bitstream_switchings')
+
     def __init__(self):
         SegmentBase.__init__(self)
 
@@ -235,6 +301,8 @@ class MultipleSegmentBase(SegmentBase):
 
 
 class SegmentTemplate(MultipleSegmentBase):
+    __slots__ = ('media', 'index', 'initialization', 'bitstream_switching')
+
     def __init__(self):
         MultipleSegmentBase.__init__(self)
 
@@ -261,6 +329,8 @@ class SegmentTemplate(MultipleSegmentBase):
 
 
 class SegmentList(MultipleSegmentBase):
+    __slots__ = ('segment_urls',)
+
     def __init__(self):
         MultipleSegmentBase.__init__(self)
 
@@ -278,6 +348,8 @@ class SegmentList(MultipleSegmentBase):
 
 
 class Event(XMLNode):
+    __slots__ = ('event_value', 'presentation_time', 'duration', 'id')
+
     def __init__(self):
         self.event_value = None                               # xs:string
         self.presentation_time = None                         # xs:unsignedLong
@@ -298,6 +370,8 @@ class Event(XMLNode):
 
 
 class Descriptor(XMLNode):
+    __slots__ = ('scheme_id_uri', 'value', 'id')
+
     def __init__(self):
         self.scheme_id_uri = ''                               # xs:anyURI (required)
         self.value = None                                     # xs:string
@@ -315,6 +389,8 @@ class Descriptor(XMLNode):
 
 
 class ContentComponent(XMLNode):
+    __slots__ = ('id', 'lang', 'content_type', 'par', 'accessibilities', 'roles', 'ratings', 'viewpoints')
+
     def __init__(self):
         self.id = None                                        # xs:unsigendInt
         self.lang = None                                      # xs:language
@@ -350,6 +426,11 @@ class ContentComponent(XMLNode):
 
 
 class RepresentationBase(XMLNode):
+    __slots__ = ('profiles', 'width', 'height', 'sar', 'frame_rate', 'audio_sampling_rate', 'mime_type',
+                 'segment_profiles', 'codecs', 'maximum_sap_period', 'start_with_sap', 'max_playout_rate',
+                 'coding_dependency', 'scan_type', 'frame_packings', 'audio_channel_configurations',
+                 'content_protections', 'essential_properties', 'supplemental_properties', 'inband_event_streams')
+
     def __init__(self):
         self.profiles = None                                  # xs:string
         self.width = None                                     # xs:unsigendInt
@@ -421,6 +502,9 @@ class RepresentationBase(XMLNode):
 
 
 class Representation(RepresentationBase):
+    __slots__ = ('id', 'bandwidth', 'quality_ranking', 'dependency_id', 'num_channels', 'sample_rate', 'base_urls',
+                 'segment_bases', 'segment_lists', 'segment_templates', 'sub_representations')
+
     def __init__(self):
         RepresentationBase.__init__(self)
 
@@ -471,6 +555,8 @@ class Representation(RepresentationBase):
 
 
 class SubRepresentation(RepresentationBase):
+    __slots__ = ('level', 'bandwidth', 'dependency_level', 'content_component')
+
     def __init__(self):
         RepresentationBase.__init__(self)
 
@@ -497,6 +583,12 @@ class SubRepresentation(RepresentationBase):
 
 
 class AdaptationSet(RepresentationBase):
+    __slots__ = ('id', 'group', 'lang', 'content_type', 'par', 'min_bandwidth', 'max_bandwidth', 'min_width',
+                 'max_width', 'min_height', 'max_height', 'min_frame_rate', 'max_frame_rate', 'segment_alignment',
+                 'subsegment_alignment', 'subsegment_starts_with_sap', 'bitstream_switching', 'accessibilities',
+                 'roles', 'ratings', 'viewpoints', 'content_components', 'base_urls', 'segment_bases',
+                 'segment_lists', 'segment_templates', 'representations')
+
     def __init__(self):
         RepresentationBase.__init__(self)
 
@@ -595,6 +687,8 @@ class AdaptationSet(RepresentationBase):
 
 
 class EventStream(XMLNode):
+    __slots__ = ('scheme_id_uri', 'value', 'timescale', 'events')
+
     def __init__(self):
         self.scheme_id_uri = None                             # xs:anyURI (required)
         self.value = None                                     # xs:string
@@ -618,6 +712,9 @@ class EventStream(XMLNode):
 
 
 class Period(XMLNode):
+    __slots__ = ('id', 'start', 'duration', 'bitstream_switching', 'base_urls', 'segment_bases', 'segment_lists',
+                 'segment_templates', 'asset_identifiers', 'event_streams', 'adaptation_sets', 'subsets')
+
     def __init__(self):
         self.id = None                                        # xs:string
         self.start = None                                     # xs:duration
@@ -635,8 +732,8 @@ class Period(XMLNode):
 
     def parse(self, xmlnode):
         self.id = parse_attr_value(xmlnode, 'id', str)
-        self.start = parse_attr_value(xmlnode, 'start', str)
-        self.duration = parse_attr_value(xmlnode, 'duration', str)
+        self.start = parse_attr_value(xmlnode, 'start', parse_duration)
+        self.duration = parse_attr_value(xmlnode, 'duration', parse_duration)
         self.bitstream_switching = parse_attr_value(xmlnode, 'bitstreamSwitching', bool)
 
         self.base_urls = parse_child_nodes(xmlnode, 'BaseURL', BaseURL)
@@ -665,6 +762,11 @@ class Period(XMLNode):
 
 
 class MPD(XMLNode):
+    __slots__ = ('xmlns', 'id', 'type', 'profiles', 'availability_start_time', 'availability_end_time',
+                 'publish_time', 'media_presentation_duration', 'minimum_update_period', 'min_buffer_time',
+                 'time_shift_buffer_depth', 'suggested_presentation_delay', 'max_segment_duration',
+                 'max_subsegment_duration', 'program_informations', 'base_urls', 'locations', 'periods', 'metrics')
+
     def __init__(self):
         self.xmlns = None                                     # xmlns
         self.id = None                                        # xs:string
@@ -695,13 +797,13 @@ class MPD(XMLNode):
         self.availability_start_time = parse_attr_value(xmlnode, 'availabilityStartTime', str)
         self.availability_end_time = parse_attr_value(xmlnode, 'availabilityEndTime', str)
         self.publish_time = parse_attr_value(xmlnode, 'publishTime', str)
-        self.media_presentation_duration = parse_attr_value(xmlnode, 'mediaPresentationDuration', str)
-        self.minimum_update_period = parse_attr_value(xmlnode, 'minimumUpdatePeriod', str)
-        self.min_buffer_time = parse_attr_value(xmlnode, 'minBufferTime', str)
-        self.time_shift_buffer_depth = parse_attr_value(xmlnode, 'timeShiftBufferDepth', str)
-        self.suggested_presentation_delay = parse_attr_value(xmlnode, 'suggestedPresentationDelay', str)
-        self.max_segment_duration = parse_attr_value(xmlnode, 'maxSegmentDuration', str)
-        self.max_subsegment_duration = parse_attr_value(xmlnode, 'maxSubsegmentDuration', str)
+        self.media_presentation_duration = parse_attr_value(xmlnode, 'mediaPresentationDuration', parse_duration)
+        self.minimum_update_period = parse_attr_value(xmlnode, 'minimumUpdatePeriod', parse_duration)
+        self.min_buffer_time = parse_attr_value(xmlnode, 'minBufferTime', parse_duration)
+        self.time_shift_buffer_depth = parse_attr_value(xmlnode, 'timeShiftBufferDepth', parse_duration)
+        self.suggested_presentation_delay = parse_attr_value(xmlnode, 'suggestedPresentationDelay', parse_duration)
+        self.max_segment_duration = parse_attr_value(xmlnode, 'maxSegmentDuration', parse_duration)
+        self.max_subsegment_duration = parse_attr_value(xmlnode, 'maxSubsegmentDuration', parse_duration)
 
         self.program_informations = parse_child_nodes(xmlnode, 'ProgramInformation', ProgramInformation)
         self.base_urls = parse_child_nodes(xmlnode, 'BaseURL', BaseURL)
@@ -1,24 +1,87 @@
+from io import BytesIO
 from urllib2 import urlopen
+from xml.etree import cElementTree
 from nodes import MPD
 from utils import *
 
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+# the parser backends which can be used here
+BACKENDS = (['lxml'] if lxml_etree is not None else []) + ['etree', 'minidom']
+
 class MPDParser(object):
+    # one of BACKENDS. lxml is used only if it is installed.
+    backend = BACKENDS[0]
+
     @classmethod
-    def load_xmldom(cls, string_or_url):
+    def load_string(cls, string_or_url):
         if 'urn:mpeg:dash:schema:mpd:2011' in string_or_url:
-            mpd_string = string_or_url
+            return string_or_url
+        try:
+            return urlopen(string_or_url).read()
+        except ValueError:
+            return open(string_or_url).read()
+
+    @classmethod
+    def load_xmldom(cls, string_or_url):
+        return minidom.parseString(cls.load_string(string_or_url))
+
+    """
+    Parse with ElementTree (or lxml) and strip the namespaces from the tags so the
+    elements can be looked up by their local name. Returns an element holding the
+    MPD element as its only child, like the minidom document does, and the namespace of the MPD.
+    """
+    @classmethod
+    def load_etree(cls, string_or_url, backend='etree'):
+        mpd_file = BytesIO(cls.load_string(string_or_url))
+        if backend == 'lxml':
+            events = lxml_etree.iterparse(mpd_file, remove_comments=True, remove_pis=True)
+            document = lxml_etree.Element('document')
         else:
-            try:
-                mpd_string = urlopen(string_or_url).read()
-            except ValueError:
-                mpd_string = open(string_or_url).read()
+            events = cElementTree.iterparse(mpd_file)
+            document = cElementTree.Element('document')
+
+        namespace = None
+        root = None
+        for _, root in events:
+            tag = root.tag
+            if tag[0] == '{':
+                end = tag.index('}')
+                namespace = tag[1:end]
+                root.tag = tag[end + 1:]
+        document.append(root)
+        return document, namespace
+
+    """
+    `options` is a ParseOptions, e.g. to parse only some of the elements or to parse lazily.
+    """
+    @classmethod
+    def parse(cls, string_or_url, backend=None, options=FULL_PARSE):
+        backend = backend or cls.backend
+        if backend not in BACKENDS:
+            raise ValueError("MPD parser backend is not available: {}".format(backend))
+        if backend == 'minidom':
+            xml_root_node = cls.load_xmldom(string_or_url)
+            return cls.parse_mpd(xml_root_node, options)
 
-        return minidom.parseString(mpd_string)
+        xml_root_node, namespace = cls.load_etree(string_or_url, backend)
+        mpd = cls.parse_mpd(xml_root_node, options)
+        # the default namespace is not an attribute in ElementTree
+        mpd.xmlns = namespace
+        return mpd
 
     @classmethod
-    def parse(cls, string_or_url):
-        xml_root_node = cls.load_xmldom(string_or_url)
-        return parse_child_nodes(xml_root_node, 'MPD', MPD)[0]
+    def parse_mpd(cls, xml_root_node, options):
+        previous = set_parse_options(options)
+        try:
+            mpd = MPD()
+            mpd.parse(find_child_nodes(xml_root_node, 'MPD')[0])
+            return mpd
+        finally:
+            set_parse_options(previous)
 
     @classmethod
     def write(cls, mpd, filepath):
@@ -1,9 +1,27 @@
+from collections import OrderedDict
 from xml.dom import minidom
+from xml.etree import cElementTree
 
 import re
 
+try:
+    from lxml import etree as lxml_etree
+    _ETREE_TYPES = (type(cElementTree.Element('e')), lxml_etree._Element)
+except ImportError:
+    _ETREE_TYPES = (type(cElementTree.Element('e')),)
+
+"""
+The parse helpers work on both minidom nodes and ElementTree (or lxml) elements.
+ElementTree elements are expected to have their namespace stripped from the tag.
+"""
+def _is_dom(xmlnode):
+    return type(xmlnode) not in _ETREE_TYPES
+
 
 def _find_child_nodes_by_name(parent, name):
+    if not _is_dom(parent):
+        return parent.findall(name)
+
     nodes = []
     for node in parent.childNodes:
         if node.nodeType == node.ELEMENT_NODE and node.localName == name:
@@ -11,42 +29,173 @@ def _find_child_nodes_by_name(parent, name):
     return nodes
 
 
+def find_child_nodes(xmlnode, tag_name):
+    return _find_child_nodes_by_name(xmlnode, tag_name)
+
+
+"""
+How the child nodes are parsed. Only the child elements whose tag is in `tags` are parsed
+(all of them if None), the others are left None. With `lazy`, the child nodes of a collection
+are parsed on its first access; the parsed XML is kept until then.
+"""
+class ParseOptions(object):
+    __slots__ = ('tags', 'lazy')
+
+    def __init__(self, tags=None, lazy=False):
+        self.tags = frozenset(tags) if tags is not None else None
+        self.lazy = lazy
+
+FULL_PARSE = ParseOptions()
+
+_parse_options = FULL_PARSE
+
+
+"""
+Set the options of the following parses, returns the previous ones
+"""
+def set_parse_options(options):
+    global _parse_options
+    previous, _parse_options = _parse_options, options
+    return previous
+
+
+"""
+Collection of child nodes which are parsed on its first access, with the options it was created with.
+It is never empty, so testing it does not parse it.
+"""
+class LazyNodes(list):
+    __slots__ = ('elements', 'node_type', 'options')
+
+    def __init__(self, elements, node_type, options):
+        list.__init__(self)
+        self.elements = elements
+        self.node_type = node_type
+        self.options = options
+
+    def load(self):
+        if self.elements is None:
+            return
+        elements, self.elements = self.elements, None
+        previous = set_parse_options(self.options)
+        try:
+            list.extend(self, [_parse_node(elem, self.node_type) for elem in elements])
+        finally:
+            set_parse_options(previous)
+
+    def __nonzero__(self):
+        return self.elements is not None or list.__len__(self) > 0
+
+
+def _loading(method):
+    def load_first(self, *args):
+        self.load()
+        return method(self, *args)
+    return load_first
+
+for _name in ('__iter__', '__reversed__', '__len__', '__contains__', '__getitem__', '__getslice__',
+              '__setitem__', '__setslice__', '__delitem__', '__delslice__', '__add__', '__iadd__',
+              '__mul__', '__eq__', '__ne__', '__lt__', '__le__', '__gt__', '__ge__', '__repr__',
+              'append', 'extend', 'insert', 'pop', 'remove', 'index', 'count', 'reverse', 'sort'):
+    setattr(LazyNodes, _name, _loading(getattr(list, _name)))
+
+
+def _is_value_type(node_type):
+    return isinstance(node_type, (str, unicode)) or node_type is str
+
+
+def _parse_node(elem, node_type):
+    if _is_value_type(node_type):
+        return parse_node_value(elem, str)
+    node = node_type()
+    node.parse(elem)
+    return node
+
+
 def parse_child_nodes(xmlnode, tag_name, node_type):
+    options = _parse_options
+    if options.tags is not None and tag_name not in options.tags:
+        return None
+
     elements = _find_child_nodes_by_name(xmlnode, tag_name)
     if not elements:
         return None
 
-    nodes = []
-    for elem in elements:
-        if isinstance(node_type, (str, unicode)):
-            node = xmlnode.firstChild.nodeValue
-        else:
-            node = node_type()
-            node.parse(elem)
-        nodes.append(node)
-
-    return nodes
+    if options.lazy and not _is_value_type(node_type):
+        return LazyNodes(elements, node_type, options)
+    return [_parse_node(elem, node_type) for elem in elements]
 
 
 def parse_node_value(xmlnode, value_type):
-    node_val = xmlnode.firstChild.nodeValue
+    if _is_dom(xmlnode):
+        node_val = xmlnode.firstChild.nodeValue if xmlnode.firstChild else None
+    else:
+        node_val = xmlnode.text
     if node_val:
         return value_type(node_val)
     return None
 
 
 def parse_attr_value(xmlnode, attr_name, value_type):
-    if not xmlnode.attributes.has_key(attr_name):
-        return None
-
-    attr_val = xmlnode.attributes[attr_name].nodeValue
-    if isinstance(value_type, list):
+    if type(xmlnode) in _ETREE_TYPES:
+        attr_val = xmlnode.get(attr_name)
+        if attr_val is None:
+            return None
+    else:
+        if not xmlnode.attributes.has_key(attr_name):
+            return None
+        attr_val = xmlnode.attributes[attr_name].nodeValue
+
+    if type(value_type) is list:
         attr_type = type(value_type[0]) if len(value_type) > 0 else str
         return [attr_type(elem) for elem in re.split(r',| ', attr_val)]
 
     return value_type(attr_val)
 
 
+DURATION_PATTERN = re.compile(r'(-)?P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)W)?(?:(\d+)D)?'
+                              r'(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?)?$')
+# seconds of each field of DURATION_PATTERN. A year is 365 days and a month is 30 days.
+DURATION_FIELDS = (365 * 86400, 30 * 86400, 7 * 86400, 86400, 3600, 60, 1)
+
+"""
+xs:duration in seconds, e.g. 120.0 for PT2M. It is written back as the text it was parsed from.
+"""
+class Duration(float):
+    __slots__ = ('text',)
+
+    def __new__(cls, text):
+        match = DURATION_PATTERN.match(text)
+        # "P" and "PT" alone are not valid
+        if match is None or text.endswith(('P', 'T')):
+            raise ValueError("Invalid xs:duration: %r" % text)
+        seconds = sum(float(value) * unit for value, unit in zip(match.groups()[1:], DURATION_FIELDS) if value)
+        self = float.__new__(cls, -seconds if match.group(1) else seconds)
+        self.text = text
+        return self
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return 'Duration(%r)' % self.text
+
+DURATION_CACHE_SIZE = 256
+_duration_cache = OrderedDict()
+
+"""
+Parse an xs:duration. The same few durations come with every MPD refresh, so the most
+recently used ones are cached.
+"""
+def parse_duration(text):
+    duration = _duration_cache.pop(text, None)
+    if duration is None:
+        duration = Duration(text)
+        if len(_duration_cache) >= DURATION_CACHE_SIZE:
+            _duration_cache.popitem(last=False)
+    _duration_cache[text] = duration
+    return duration
+
+
 def write_child_node(xmlnode, tag_name, node):
     if node:
         xmldoc = xmlnode if isinstance(xmlnode, minidom.Document) else xmlnode.ownerDocument